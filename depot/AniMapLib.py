@@ -1,41 +1,183 @@
 import sys
 import os
+import csv
+import json
+import time
+import queue
+import cProfile
+import hashlib
+import difflib
 import numpy as np
-import bezier
-from datetime import timedelta
-
-def get_values_curved_line(point1,point2):
-
-    x_diff = abs(point1[0] - point2[0])
-    y_diff = abs(point1[1] - point2[1])
-    xm = (point1[0] + point2[0])/2
-    ym = (point1[1] + point2[1])/2
-    hy = x_diff/3
-    hx = y_diff/3
-    if point1[0]>point2[0] and point1[1]<point2[1]:
-        nx = xm+hx
-        ny = ym+hy
-    elif point1[0]<point2[0] and point1[1]<point2[1]:
-        nx = xm-hx
-        ny = ym+hy
-    elif point1[0]<point2[0] and point1[1]>point2[1]:
-        nx = xm-hx
-        ny = ym-hy
+from datetime import date, timedelta
+from functools import lru_cache, partial
+from contextlib import contextmanager
+
+from depot.ingest import missing_columns
+
+def curved_lines(endpoints, n_points=30):
+    """x and y values of the quadratic Bezier arcs between endpoints of shape (arcs, 2, 2), shape (arcs, 2, n_points).
+
+    The control point sits a third of the span off the middle of the line, on the side the
+    arc bulges to for the direction of travel."""
+    p0, p2 = endpoints[:, 0], endpoints[:, 1]
+    x1, y1, x2, y2 = p0[:, 0], p0[:, 1], p2[:, 0], p2[:, 1]
+    sx = np.where(x1 < x2, -1, 1)
+    sy = np.where(y1 < y2, 1, -1)
+    p1 = np.stack([(x1 + x2) / 2 + sx * np.abs(y1 - y2) / 3, (y1 + y2) / 2 + sy * np.abs(x1 - x2) / 3], axis=1)
+    s = np.linspace(0, 1, n_points)
+    curves = ((1 - s) ** 2)[None, None, :] * p0[:, :, None] + (2 * (1 - s) * s)[None, None, :] * p1[:, :, None] + (s ** 2)[None, None, :] * p2[:, :, None]
+    return curves
+
+# Seconds and calls per stage in this process, see timer. Workers hand theirs to the
+# main process with every batch of frames.
+timings = {}
+
+# cProfile of this process and the file it is dumped to, see start_profile
+_profile = None
+
+@contextmanager
+def timer(stage, message=None):
+    """Adds the time spent in the block to timings[stage], printing message formatted with the seconds."""
+    st = time.perf_counter()
+    try:
+        yield
+    finally:
+        et = time.perf_counter() - st
+        seconds, calls = timings.get(stage, (0.0, 0))
+        timings[stage] = (seconds + et, calls + 1)
+    if message:
+        print(message.format(et)) #tm
+
+def take_timings():
+    taken = dict(timings)
+    timings.clear()
+    return taken
+
+def add_timings(taken):
+    for stage, (seconds, calls) in taken.items():
+        total, count = timings.get(stage, (0.0, 0))
+        timings[stage] = (total + seconds, count + calls)
+
+def write_metrics(path, **info):
+    """Writes the timings of all stages as JSON, or as CSV when path ends with .csv."""
+    stages = {stage: {"seconds": round(seconds, 6), "calls": calls, "mean_ms": round(1000 * seconds / calls, 3)}
+              for stage, (seconds, calls) in timings.items()}
+    if path.endswith(".csv"):
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["stage", "seconds", "calls", "mean_ms"])
+            for stage, row in stages.items():
+                writer.writerow([stage, row["seconds"], row["calls"], row["mean_ms"]])
     else:
-        nx = xm+hx
-        ny = ym-hy
+        with open(path, "w") as f:
+            json.dump(dict(info, stages=stages), f, indent=2)
+
+def start_profile(profile_dir, name):
+    global _profile
+    os.makedirs(profile_dir, exist_ok=True)
+    _profile = (cProfile.Profile(), os.path.join(profile_dir, "{}_{}.prof".format(name, os.getpid())))
+    _profile[0].enable()
+
+def start_worker_metrics(profile_dir=None):
+    """Drops the timings and profile a forked worker inherits from the main process."""
+    global _profile
+    timings.clear()
+    if _profile is not None:
+        _profile[0].disable()
+        _profile = None
+    if profile_dir:
+        from multiprocessing.util import Finalize
+        start_profile(profile_dir, "worker")
+        # written once, when the pool is closed and the worker exits
+        Finalize(None, dump_profile, exitpriority=0)
+
+def dump_profile():
+    """Writes the profile of this process so far, viewable with pstats or snakeviz."""
+    if _profile is not None:
+        profiler, path = _profile
+        profiler.disable()
+        profiler.dump_stats(path)
+        profiler.enable()
+
+def finish_run(metrics_file, **info):
+    """Dumps the profile of the main process and the metrics of the run, when asked for."""
+    dump_profile()
+    if metrics_file:
+        write_metrics(metrics_file, **info)
 
-    points=[point1]
-    points.append([nx,ny])
-    points.append(point2)
+# Render the static layers once and keep the pixels to blit every frame onto
+def cache_background(fig, overlays):
+    for artist in overlays:
+        artist.set_visible(False)
+    fig.canvas.draw()
+    background = fig.canvas.copy_from_bbox(fig.bbox)
+    for artist in overlays:
+        artist.set_visible(True)
+    return background
 
-    points=np.array(points).transpose()
-    points=np.asfortranarray(points)
-    curve = bezier.Curve(points,degree=2)
-    s_val=np.linspace(0,1,30)
-    f=curve.evaluate_multi(s_val)
+def draw_frame(fig, background, artists):
+    with timer("frame base"):
+        fig.canvas.restore_region(background)
+    with timer("frame draw"):
+        for artist in artists:
+            fig.draw_artist(artist)
 
-    return list(f)[0], list(f)[1]
+def frame_pixels(fig):
+    return np.asarray(fig.canvas.buffer_rgba())
+
+def axes_pixels(ax):
+    bbox = ax.get_window_extent()
+    return bbox.width, bbox.height
+
+# Polygons drawn the way geopandas draws them, without its full redraw per plot call
+def polygon_paths(geoms):
+    from matplotlib.path import Path
+    paths = []
+    for geom in geoms:
+        if geom is None or geom.is_empty:
+            continue
+        parts = [geom] if geom.geom_type == "Polygon" else geom.geoms
+        for part in parts:
+            rings = [Path(np.asarray(part.exterior.coords)[:, :2], closed=True)]
+            rings += [Path(np.asarray(ring.coords)[:, :2], closed=True) for ring in part.interiors]
+            paths.append(Path.make_compound_path(*rings))
+    return paths
+
+# Every polygon of a map in one collection, transparent until recolored
+def fill_layer(ax, geoms):
+    from matplotlib.collections import PatchCollection
+    from matplotlib.patches import PathPatch
+    paths = []
+    rows = []
+    for geom in geoms:
+        row_paths = polygon_paths([geom])
+        rows.append(np.arange(len(paths), len(paths) + len(row_paths)))
+        paths += row_paths
+    collection = PatchCollection([PathPatch(path) for path in paths], facecolor="none", edgecolor="none")
+    ax.add_collection(collection, autolim=False)
+    return collection, rows
+
+def patch_index(names, rows):
+    """maps each name of the map rows to the positions of their patches in the fill layer."""
+    index = {}
+    for name, row in zip(names, rows):
+        index.setdefault(name, []).append(row)
+    return {name: np.concatenate(index[name]) for name in index}
+
+def fill_colors(count, fills):
+    """RGBA of count patches with each (patches, color, alpha) of fills painted over the ones before it, as stacked collections would."""
+    from matplotlib.colors import to_rgb
+    rgba = np.zeros((count, 4))
+    for patches, color, alpha in fills:
+        # premultiplied color, blended over what is already painted
+        rgba[patches, :3] = np.multiply(to_rgb(color), alpha) + rgba[patches, :3] * (1 - alpha)
+        rgba[patches, 3] = alpha + rgba[patches, 3] * (1 - alpha)
+    painted = rgba[:, 3] > 0
+    rgba[painted, :3] /= rgba[painted, 3:]
+    return rgba
+
+def recolor(collection, fills):
+    collection.set_facecolor(fill_colors(len(collection.get_paths()), fills))
 
 def split(x,n):
     nums = []
@@ -59,24 +201,626 @@ def split(x,n):
             nums_end.append(nums[i]+nums_end[i-1])
     return nums_end
 
-def remove_frames(L,Title,limit,frames_per_day):
+# Numbers the arcs between the rows of pairs, x and y of both endpoints, new ones in order of appearance
+def arc_ids(arcs, pairs):
+    distinct, first, inverse = np.unique(pairs, axis=0, return_index=True, return_inverse=True)
+    ids = np.empty(len(distinct), dtype=np.int64)
+    for u in np.argsort(first):
+        ids[u] = arcs.setdefault(tuple(distinct[u]), len(arcs))
+    return ids[inverse.reshape(-1)]
+
+# Points [start, end) of an arc shown diff frames away from its transfer: drawn in before, drawn out after
+def arc_range(diff, nums_end):
+    if diff < 0:
+        return 0, nums_end[len(nums_end) - 1 + diff]
+    elif diff > 0:
+        return nums_end[diff - 1], nums_end[-1]
+    else:
+        return 0, nums_end[-1]
+
+# Frames to render, days without points or lines are scaled to their last frame
+def remove_frames(plotted,limit,frames_per_day):
+    frames = []
+    for i in range(0, limit, frames_per_day):
+        if plotted[i:i+frames_per_day].any():
+            frames.extend(range(i, i+frames_per_day))
+        else:
+            frames.append(i+frames_per_day-1)
+    return frames
+
+# Content of a resolved frame, frames with the same key render to the same image
+def frame_key(L, Title):
+    h = hashlib.blake2b(Title.encode(), digest_size=16)
+    for frame in L:
+        for value in frame:
+            if isinstance(value, np.ndarray):
+                h.update(value.tobytes())
+            else:
+                h.update(repr(value).encode())
+            h.update(b"|")
+        h.update(b";")
+    return h.hexdigest()
+
+# Resolves the frames of frame_keys in its worker processes, see init_keys
+_resolve = None
+
+def init_keys(resolve):
+    global _resolve
+    _resolve = resolve
+
+def batch_keys(batch):
+    return [frame_key(_resolve(t), title) for t, title in batch]
+
+def frame_keys(frames, Title, resolve, threads=1, batch_size=64):
+    """Content keys of frames shown with Title, resolved in batches on threads processes.
+
+    resolve is handed to the processes when they start, so it must pickle where they are spawned."""
+    pairs = [(t, Title[i]) for i, t in enumerate(frames)]
+    batches = [pairs[n:n + batch_size] for n in range(0, len(pairs), batch_size)]
+    if threads <= 1 or len(batches) <= 1:
+        return [frame_key(resolve(t), title) for t, title in pairs]
+    from multiprocessing import Pool
+    with Pool(threads, initializer=init_keys, initargs=(resolve,)) as p:
+        return [key for keys in p.imap(batch_keys, batches) for key in keys]
+
+def dedup_frames(frames, Title, resolve, known=(), threads=1):
+    """One job [t, title, i, dups] per distinct frame content, in order of first appearance, and their keys.
+
+    frames are the timeline frames shown at each output position i with Title[i],
+    dups the later positions showing the same content. known holds the keys of the
+    leading positions when they are known already, see unchanged_keys; the others are
+    resolved on threads processes. The jobs and keys of every position are built at once,
+    not lazily, so their memory grows with the number of frames."""
+    keys = list(known[:len(frames)]) + frame_keys(frames[len(known):], Title[len(known):], resolve, threads)
+    jobs = {}
+    for i, (t, key) in enumerate(zip(frames, keys)):
+        if key in jobs:
+            jobs[key][3].append(i)
+        else:
+            jobs[key] = [t, Title[i], i, []]
+    return list(jobs.values()), list(jobs.keys())
+
+def first_change(previous, timeline, counts=None, tables=("arcs",)):
+    """First frame at which two built timelines of a module can differ, within the frames of both.
+
+    counts names the arrays of row names and of their counts per day, when the timelines have them;
+    tables the arrays events refer to by position, which may only grow at the end."""
+    if json.dumps(previous.params, sort_keys=True) != json.dumps(timeline.params, sort_keys=True):
+        return 0
+    limit = min(previous.limit, timeline.limit)
+    first = limit
+    for layer in set(previous.layers) | set(timeline.layers):
+        if layer not in previous.layers or layer not in timeline.layers:
+            # a layer with no events until now
+            first = min(first, (previous.layers.get(layer) or timeline.layers[layer])["start"][0])
+            continue
+        old, new = previous.layers[layer], timeline.layers[layer]
+        # events in start order, past the shorter animation clipped away
+        n_old, n_new = np.searchsorted(old["start"], limit), np.searchsorted(new["start"], limit)
+        n = min(n_old, n_new)
+        same = np.minimum(old["end"][:n], limit) == np.minimum(new["end"][:n], limit)
+        for name in old:
+            if name not in ("end", "order", "span"):
+                same &= np.asarray(old[name][:n]) == np.asarray(new[name][:n])
+        if not same.all():
+            k = int(np.argmin(same))
+            first = min(first, old["start"][k], new["start"][k])
+        elif n_old != n_new:
+            first = min(first, (old if n_old > n else new)["start"][n])
+    for table in tables:
+        if table in previous.arrays:
+            n = min(len(previous.arrays[table]), len(timeline.arrays[table]))
+            if not np.array_equal(previous.arrays[table][:n], timeline.arrays[table][:n]):
+                return 0
+    if counts:
+        # counts of every name on both sides, per day of both
+        names, day_counts = counts
+        frames_per_day = timeline.params["frames_per_day"]
+        days = limit // frames_per_day
+        union = {name: r for r, name in enumerate(np.union1d(previous.arrays[names], timeline.arrays[names]))}
+        aligned = []
+        for t in (previous, timeline):
+            full = np.zeros((len(union), days), dtype=np.int64)
+            full[[union[name] for name in t.arrays[names]]] = t.arrays[day_counts][:, :days]
+            aligned.append(full)
+        changed = np.nonzero((aligned[0] != aligned[1]).any(axis=0))[0]
+        if len(changed):
+            first = min(first, int(changed[0]) * frames_per_day)
+    return int(first)
+
+def unchanged_keys(previous, timeline, frames, titles, counts=None, tables=("arcs",)):
+    """Keys of the leading output positions whose content cannot differ from the previous compile of the timeline."""
+    if previous is None:
+        return []
+    first = first_change(previous, timeline, counts, tables)
+    frames, titles = np.asarray(frames), np.asarray(titles)
+    old_frames, old_titles = previous.arrays["frames"], previous.arrays["titles"]
+    n = min(len(frames), len(old_frames))
+    same = (frames[:n] == old_frames[:n]) & (titles[:n] == old_titles[:n]) & (frames[:n] < first)
+    n = n if same.all() else int(np.argmin(same))
+    return [str(key) for key in previous.arrays["keys"][previous.arrays["job_of"][:n]]]
+
+# Job index of every output position, the dedup groups as one array
+def job_index(j_list, num_frames):
+    job_of = np.zeros(num_frames, dtype=np.int64)
+    for n, j in enumerate(j_list):
+        job_of[[j[2]] + j[3]] = n
+    return job_of
+
+def compiled_jobs(frames, titles, job_of):
+    """The jobs [t, title, i, dups] of dedup_frames, from the arrays of a compiled timeline."""
+    jobs = []
+    for i, n in enumerate(job_of):
+        if n == len(jobs):
+            jobs.append([int(frames[i]), str(titles[i]), i, []])
+        else:
+            jobs[n][3].append(i)
+    return jobs
+
+def titled_jobs(timeline, title_format):
+    """The jobs and keys of a compiled timeline with its frames titled in title_format.
+
+    Output positions share a job when they shared one in the timeline and get the same title,
+    so a format coarser than the compiled one may render some repeated frames again."""
+    frames, job_of = timeline.arrays["frames"], timeline.arrays["job_of"]
+    keys = [str(key) for key in timeline.arrays["keys"]]
+    frames_per_day = timeline.params["frames_per_day"]
+    Title = title(title_format, date.fromisoformat(timeline.params["start_date"]), timeline.limit // frames_per_day, frames_per_day)
+    titles = [Title[t] for t in frames]
+    if titles == list(timeline.arrays["titles"]):
+        return compiled_jobs(frames, titles, job_of), keys
+    known = [hashlib.blake2b((keys[n] + titles[i]).encode(), digest_size=16).hexdigest() for i, n in enumerate(job_of)]
+    return dedup_frames([int(t) for t in frames], titles, None, known)
+
+def variants(config_opts, out_dir, module):
+    """The output directory and options of every variant of the config, or of the config itself when it lists none.
+
+    A variant renders to the directory of its name in out_dir, its keys in place of those of the config."""
+    if not config_opts.get("variants"):
+        return [(out_dir, config_opts)]
+    outputs = []
+    for variant in config_opts["variants"]:
+        opts = dict(config_opts)
+        for key, value in variant.items():
+            opts["title_format_" + module if key == "title_format" else key] = value
+        outputs.append((get_outdir(out_dir, str(variant["name"])), opts))
+    return outputs
+
+# Output positions [first, last) of a shard given as i/N (i from 1 to N) or first:last
+def shard_range(shard, num_frames):
+    if shard is None:
+        return 0, num_frames
+    try:
+        if "/" in shard:
+            i, n = [int(v) for v in shard.split("/")]
+            if not 1 <= i <= n:
+                raise ValueError
+            return (i - 1) * num_frames // n, i * num_frames // n
+        first, last = shard.split(":")
+        first = int(first) if first else 0
+        last = int(last) if last else num_frames
+        return max(first, 0), min(last, num_frames)
+    except ValueError:
+        print("\t[!] {} is not a shard, use i/N or first:last".format(shard))
+        sys.exit()
+
+def shard_jobs(j_list, keys, first, last):
+    """The jobs showing output positions [first, last), each rendered at its first position in the shard."""
+    jobs, shard_keys = [], []
+    for (t, Title, i, dups), key in zip(j_list, keys):
+        positions = [f for f in [i] + dups if first <= f < last]
+        if positions:
+            jobs.append([t, Title, positions[0], positions[1:]])
+            shard_keys.append(key)
+    return jobs, shard_keys
+
+# Days since start_date of a window given as from:to, dates as Year-Month-Day, either side optional
+def date_window(window, start_date, delta_days):
+    if window is None:
+        return 0, delta_days
+    try:
+        first, last = [(date.fromisoformat(d) - start_date).days if d else None for d in window.split(":")]
+    except ValueError:
+        print("\t[!] {} is not a window, use Year-Month-Day:Year-Month-Day".format(window))
+        sys.exit()
+    return max(first or 0, 0), min(delta_days if last is None else last, delta_days)
+
+def preview_jobs(j_list, keys, job_of, frames, frames_per_day, every, first_day, last_day):
+    """Jobs of the first frame of every nth day in [first_day, last_day) at consecutive output positions, and their number.
+
+    Sampled frames with the same key share a job, rendered once."""
+    try:
+        every = int(every)
+        if every < 1:
+            raise ValueError
+    except ValueError:
+        print("\t[!] {} is not a number of days, use a whole number from 1".format(every))
+        sys.exit()
+    jobs, preview_keys, job_of_key = [], [], {}
+    num_frames = 0
+    days = np.asarray(frames) // frames_per_day
+    for i, day in enumerate(days):
+        if first_day <= day < last_day and (day - first_day) % every == 0 and (i == 0 or days[i-1] != day):
+            n = job_of[i]
+            if keys[n] in job_of_key:
+                jobs[job_of_key[keys[n]]][3].append(num_frames)
+            else:
+                job_of_key[keys[n]] = len(jobs)
+                jobs.append([j_list[n][0], j_list[n][1], num_frames, []])
+                preview_keys.append(keys[n])
+            num_frames += 1
+    if not jobs:
+        print("\t[!] No frames to preview, the window holds no days of the animation")
+        sys.exit()
+    return jobs, preview_keys, num_frames
+
+# Identifies the settings and inputs, besides frame content, that rendered frames depend on
+def render_key(*settings):
+    values = []
+    for value in settings:
+        if isinstance(value, str) and os.path.isfile(value):
+            stat = os.stat(value)
+            value = [os.path.abspath(value), stat.st_mtime_ns, stat.st_size]
+        values.append(value)
+    return hashlib.blake2b(repr(values).encode(), digest_size=16).hexdigest()
+
+# Keys of the config file needed by every module, by one of them, and those with defaults
+config_keys = {"all": ["threads", "dpi", "frames_per_day", "frames_for_line", "start_date", "end_date"],
+               "region": ["title_format_region", "point_decay_days", "point_size", "transparency_alpha",
+                          "region_json", "municipalities_json", "region_cases", "world_transfers_file", "milestones"],
+               "world": ["title_format_world", "world_json", "world_cases", "centroids_file", "world_transfers_file"],
+               "optional": ["region_transfers_file", "name_aliases", "cache_dir", "lod_pixels", "output", "video_file",
+                            "fps", "video_codec", "ffmpeg", "duplicate_frames", "png_compression", "chunk_rows", "engine",
+                            "figure_size", "variants"]}
+
+# Keys a variant of the output can set, see variants
+variant_keys = ["name", "dpi", "title_format", "figure_size", "output", "png_compression", "video_file"]
+
+# Columns read from the csv files, by module and the key naming the file
+csv_columns = {"region": {"region_cases": ["ID", "Longtitude", "Latitude", "Colony", "Day", "Month", "Year", "Municipality"],
+                          "world_transfers_file": ["from", "to"],
+                          "milestones": ["Day", "Month", "Year", "Text"]},
+               "world": {"world_cases": ["ID", "Day", "Month", "Year", "Country", "Region", "End"],
+                         "centroids_file": ["Region", "Latitude", "Longitude"],
+                         "world_transfers_file": ["from", "to", "Day", "Month", "Year"]}}
+
+map_keys = {"region": ["region_json", "municipalities_json"], "world": ["world_json"]}
+
+def check_config(config_opts, module, parse=True):
+    """Exits on missing or malformed config keys and map files, and with parse on missing csv files or columns.
+
+    Unknown keys, likely typos of optional ones, are only reported."""
+    if not isinstance(config_opts, dict):
+        print("\t[!] The config file holds no keys")
+        sys.exit()
+    errors = []
+    for key in config_keys["all"] + config_keys[module]:
+        if key not in config_opts:
+            errors.append("{} is missing from the config file".format(key))
+    known = [key for keys in config_keys.values() for key in keys]
+    for key in config_opts:
+        if key not in known:
+            close = difflib.get_close_matches(key, known, 1)
+            print("\t[!] {} is not a config key{}".format(key, ", did you mean {}?".format(close[0]) if close else ""))
+
+    for key in ["threads", "frames_per_day", "frames_for_line"] + (["point_decay_days"] if module == "region" else []):
+        if key in config_opts and not (isinstance(config_opts[key], int) and config_opts[key] >= 1):
+            errors.append("{} must be a whole number of at least 1, not {}".format(key, config_opts[key]))
+    variants = config_opts.get("variants") or []
+    if not isinstance(variants, list):
+        errors.append("variants must be a list of variants")
+        variants = []
+    names = []
+    for n, variant in enumerate(variants):
+        if not isinstance(variant, dict) or "name" not in variant:
+            errors.append("variant {} has no name".format(n + 1))
+            continue
+        if str(variant["name"]) in names:
+            errors.append("variant {} is listed twice".format(variant["name"]))
+        names.append(str(variant["name"]))
+        for key in variant:
+            if key not in variant_keys:
+                errors.append("{} is not a key of a variant, use {}".format(key, ", ".join(variant_keys)))
+
+    # output settings of the config and of each variant
+    for opts, where in [(config_opts, "")] + [(variant, " of variant {}".format(variant["name"])) for variant in variants if isinstance(variant, dict) and "name" in variant]:
+        if "dpi" in opts and not (isinstance(opts["dpi"], (int, float)) and opts["dpi"] > 0):
+            errors.append("dpi{} must be a positive number, not {}".format(where, opts["dpi"]))
+        if opts.get("png_compression", 6) not in range(10):
+            errors.append("png_compression{} must be a whole number from 0 to 9, not {}".format(where, opts["png_compression"]))
+        size = opts.get("figure_size", [1, 1])
+        if not (isinstance(size, list) and len(size) == 2 and all(isinstance(x, (int, float)) and x > 0 for x in size)):
+            errors.append("figure_size{} must be the width and height in inches, as [width, height], not {}".format(where, size))
+    for key in ["start_date", "end_date"]:
+        if key in config_opts and not isinstance(config_opts[key], date):
+            errors.append("{} must be a date as Year-Month-Day, not {}".format(key, config_opts[key]))
+    if config_opts.get("engine", "matplotlib") not in ("matplotlib", "raster"):
+        errors.append("{} is not an engine, use matplotlib or raster".format(config_opts["engine"]))
+    if not errors and config_opts["end_date"] <= config_opts["start_date"]:
+        errors.append("end_date must come after start_date")
+
+    files = map_keys[module] + (list(csv_columns[module]) if parse else [])
+    for key in files:
+        if key in config_opts and not os.path.isfile(str(config_opts[key])):
+            errors.append("{} {} is NOT a file".format(key, config_opts[key]))
+        elif key in config_opts and key in csv_columns[module]:
+            missing = missing_columns(config_opts[key], csv_columns[module][key])
+            if missing:
+                errors.append("{} {} has no column {}".format(key, config_opts[key], ", ".join(missing)))
+
+    for error in errors:
+        print("\t[!] " + error)
+    if errors:
+        sys.exit()
+
+def plan(timeline, threads, frame_costs):
+    """Prints the frames, events and estimated render time of a compiled timeline."""
+    frames = timeline.arrays["frames"]
+    job_of = timeline.arrays["job_of"]
+    print("Frames: {} ({} distinct, {:.1f} per distinct frame)".format(len(frames), len(timeline.arrays["keys"]), len(frames) / max(len(timeline.arrays["keys"]), 1)))
+    print("Events: " + ", ".join("{} {}".format(layer, len(cols["start"])) for layer, cols in timeline.layers.items()))
+    if "arcs" in timeline.arrays:
+        print("Arcs: {}".format(len(timeline.arrays["arcs"])))
+    # a job is rendered at the first position showing it
+    job_frames = frames[np.unique(job_of, return_index=True)[1]]
+    seconds = float(np.sum(frame_costs(timeline, job_frames))) / 1000
+    print("Estimated render time: {:.0f} seconds on {} workers ({:.0f} seconds of work)".format(seconds / threads, threads, seconds))
+
+# Watching the inputs of a module, see watch
+def input_stamps(config_yaml, module):
+    """Modification time and size of the config file and of the csv files it names, None for missing ones."""
+    import yaml
+    paths = [config_yaml]
+    try:
+        with open(config_yaml) as f:
+            config_opts = yaml.safe_load(f)
+    except (OSError, yaml.YAMLError):
+        config_opts = None
+    if isinstance(config_opts, dict):
+        paths += [str(config_opts[key]) for key in csv_columns[module] if key in config_opts]
+    stamps = {}
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            stamps[path] = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            stamps[path] = None
+    return stamps
+
+def watch(config_yaml, module, run, interval=2.0):
+    """Calls run(previous) now and on every change of the config file or its csv inputs, until interrupted.
+
+    previous is what the last pass returned. A pass starts once the files stopped changing for interval seconds."""
+    previous = None
+    try:
+        while True:
+            stamps = input_stamps(config_yaml, module)
+            take_timings()
+            try:
+                previous = run(previous)
+            except SystemExit:
+                print("\t[!] Pass stopped, the output is updated on the next change of the inputs")
+            print("Watching {} and its csv files, Ctrl+C to stop".format(config_yaml))
+            changed = stamps
+            while changed == stamps:
+                time.sleep(interval)
+                changed = input_stamps(config_yaml, module)
+            # files still being written settle first
+            settled = None
+            while settled != changed:
+                settled = changed
+                time.sleep(interval)
+                changed = input_stamps(config_yaml, module)
+    except KeyboardInterrupt:
+        print("Stopped watching")
+
+# Names are matched case and accent insensitive
+@lru_cache(maxsize=None)
+def normalize_name(name):
+    from unidecode import unidecode
+    return unidecode(name.lower())
+
+def name_index(names, aliases=None):
+    """maps every normalized map name, and alias, to the positions of the names it matches."""
+    index = {}
+    for i, name in enumerate(names):
+        if isinstance(name, str):
+            index.setdefault(normalize_name(name), []).append(i)
+    if aliases:
+        for alias, name in aliases.items():
+            if normalize_name(name) in index:
+                index[normalize_name(alias)] = index[normalize_name(name)]
+    return index
+
+def match_name(index, name, unmatched):
+    """positions of the map names matching name, misses are counted in unmatched."""
+    found = index.get(normalize_name(name), [])
+    if not found:
+        unmatched[name] = unmatched.get(name, 0) + 1
+    return found
+
+def match_names(index, names, unmatched):
+    """match_name of an array of names: its distinct names, the positions found for each and the distinct name of every row."""
+    distinct, inverse, counts = np.unique(names, return_inverse=True, return_counts=True)
+    found = []
+    for name, count in zip(distinct, counts):
+        found.append(index.get(normalize_name(str(name)), []))
+        if not found[-1]:
+            unmatched[str(name)] = unmatched.get(str(name), 0) + int(count)
+    return distinct, found, inverse.reshape(-1)
+
+def report_unmatched(unmatched, kind):
+    if unmatched:
+        print("\t[!] {} {} names not found in the map:".format(len(unmatched), kind))
+        for name in sorted(unmatched):
+            print("\t\t{} ({} rows)".format(name, unmatched[name]))
+
+# Renders the frame jobs on the pool and hands the results to the sink
+# Largest batch a worker renders before handing its frames back, in estimated milliseconds and
+# in frames, so the sink records finished frames (see ImageFrames.resume) within about a second
+BATCH_MS = 500
+BATCH_FRAMES = 16
+
+def schedule(j_list, costs, threads):
+    """Batches of jobs, the most expensive first, each worth about half the remaining work of a worker up to BATCH_MS."""
+    order = np.argsort(-np.asarray(costs, dtype=float), kind="stable")
+    remaining = float(np.sum(costs))
+    batches, batch, batch_cost = [], [], 0.0
+    for n in order:
+        batch.append(j_list[n])
+        batch_cost += costs[n]
+        # guided: large batches while there is much left, single cheap frames at the end
+        if batch_cost >= min(remaining / (2 * threads), BATCH_MS) or len(batch) == BATCH_FRAMES:
+            batches.append(batch)
+            remaining -= batch_cost
+            batch, batch_cost = [], 0.0
+    if batch:
+        batches.append(batch)
+    return batches
+
+def run_batch(fplot, batch):
+    st = time.perf_counter()
+    frames = []
+    for j in batch:
+        with timer("frame"):
+            frames.append(fplot(j))
+    return os.getpid(), time.perf_counter() - st, frames, take_timings()
+
+def bounded_imap(p, func, jobs, window):
+    """func over jobs on the pool, submitting a job only while fewer than window are unconsumed.
+
+    Unlike imap, which queues every job at once, a slow consumer holds back the jobs and
+    results in flight, so memory does not grow with the number of jobs."""
+    jobs = iter(jobs)
+    results = queue.Queue()
+
+    # submits the next job, returns how many were submitted
+    def submit():
+        for job in jobs:
+            p.apply_async(func, (job,), callback=results.put, error_callback=results.put)
+            return 1
+        return 0
+
+    in_flight = sum(submit() for _ in range(window))
+    while in_flight:
+        result = results.get()
+        if isinstance(result, BaseException):
+            raise result
+        in_flight += submit() - 1
+        yield result
+
+def render_frames(p, fplot, j_list, sink, threads, costs=None):
+    """Renders the jobs on the pool into the sink, reporting the time every worker spent rendering.
+
+    Ordered sinks get the jobs one by one in output order, others in batches scheduled by their
+    estimated costs. At most two batches per worker are in flight."""
+    if sink.ordered:
+        batches = ([j] for j in j_list)
+    else:
+        batches = schedule(j_list, np.ones(len(j_list)) if costs is None else costs, threads)
+
+    st = time.time() #tm
+    busy = {}
     i = 0
-    frames_to_remove = []
-    while i < limit:
-        diff_plots = 0
-        for k in range(frames_per_day):
-            for frame in L[i+k]:
-                if frame[0] != "m" and frame[0] != "t" and diff_plots == 0: #if frames are not only text or municipality
-                    diff_plots = 1
-        if diff_plots == 0:
-            for k in range(frames_per_day-1):
-                frames_to_remove.insert(0,i+k)
-        i+=frames_per_day
-
-    for f in frames_to_remove:
-        del L[f]
-        del Title[f]
-    return L,Title
+    for pid, seconds, frames, worker_timings in bounded_imap(p, partial(run_batch, fplot), batches, 2 * threads):
+        busy[pid] = busy.get(pid, 0) + seconds
+        add_timings(worker_timings)
+        for frame in frames:
+            with timer("sink write"):
+                sink.write(frame)
+            i += 1
+            progress(i,1,len(j_list))
+    with timer("sink close"):
+        sink.close()
+    et = time.time() - st #tm
+    if j_list and et > 0:
+        usage = [busy.get(pid, 0) / et for pid in busy] + [0] * (threads - len(busy))
+        print("Workers busy " + str(int(100 * np.mean(usage))) + "% of the time (least " + str(int(100 * min(usage))) + "%, most " + str(int(100 * max(usage))) + "%)") #tm
+
+def render_outputs(args, config_opts, out_dir, module, timeline, worker_timeline, draw_maps, base_map, init_worker, fplot, frame_costs, map_files):
+    """Renders the timeline into every variant of the output, or into its preview, see variants.
+
+    draw_maps(dpi, figure_size, lod_pixels) returns the maps as drawn at that size and level of detail,
+    which base_map and init_worker of the module take along with the dpi and figure size."""
+    from multiprocessing import Pool
+    from depot.sinks import ImageFrames, get_sink, contact_sheet
+    from depot.raster import patch_pixels, share
+
+    threads = config_opts["threads"]
+    title_key = "title_format_" + module
+    outputs = [(out_dir, config_opts)] if args['--preview'] else variants(config_opts, out_dir, module)
+    distinct, rendered = 0, 0
+    for out_dir, opts in outputs:
+        dpi = opts["dpi"]
+        figure_size = opts.get("figure_size")
+        if args['--preview']:
+            dpi = float(args['--dpi']) if args['--dpi'] else dpi / 2
+            sink = ImageFrames(out_dir, dpi)
+        else:
+            sink = get_sink(opts, out_dir, dpi)
+
+        # Level of detail for drawing: the maps simplified to a fraction of a pixel
+        lod_pixels = opts.get("lod_pixels", 0.5)
+        if args['--preview']:
+            lod_pixels = max(lod_pixels, 2)
+        maps = draw_maps(dpi, figure_size, lod_pixels)
+
+        # the raster engine paints fills and points through the pixels of every patch, found once for all workers
+        engine = opts.get("engine", "matplotlib")
+        shm, patches = None, None
+        if engine == "raster":
+            with timer("raster"):
+                base = base_map(maps, dpi, figure_size)
+                shm, patches = share(patch_pixels(base["fig"], base["fills"]))
+                import matplotlib.pyplot as plt
+                plt.close(base["fig"])
+
+        #Plotting the frames
+        # titled in the format of the variant, the timeline keeps the format it was compiled with
+        frames, job_of = timeline.arrays["frames"], timeline.arrays["job_of"]
+        if opts[title_key] != timeline.params["title_format"]:
+            j_list, keys = titled_jobs(timeline, opts[title_key])
+            job_of = job_index(j_list, len(frames))
+        else:
+            j_list = compiled_jobs(frames, timeline.arrays["titles"], job_of)
+            keys = [str(key) for key in timeline.arrays["keys"]]
+        num_frames = len(frames)
+        if args['--preview']:
+            delta_days = (opts["end_date"] - opts["start_date"]).days
+            first_day, last_day = date_window(args['--window'], opts["start_date"], delta_days)
+            j_list, keys, num_frames = preview_jobs(j_list, keys, job_of, frames, opts["frames_per_day"], args['--every'], first_day, last_day)
+        first, last = shard_range(args['--shard'], num_frames)
+        j_list, keys = shard_jobs(j_list, keys, first, last)
+        # Frames already in the output directory from an earlier or interrupted run are kept
+        todo = sink.resume(j_list, keys, render_key(module, dpi, figure_size, lod_pixels, args['--preview'], engine, *map_files), num_frames, first, last)
+
+        # multiprocessing, forked after resume, every worker keeps its own copy of the maps and timeline
+        p = Pool(threads, initializer=init_worker, initargs=(maps, dpi, figure_size, sink, worker_timeline, patches, args['--profile']))
+
+        # the most expensive frames first, so no worker is left with a dense tail
+        st = timings.get("render", (0.0, 0))[0]
+        try:
+            with timer("render", "Rendered in {:.2f} seconds."):
+                render_frames(p, fplot, todo, sink, threads, frame_costs(timeline, np.array([j[0] for j in todo], dtype=np.int64)))
+            # workers exit, writing their profiles, and are not kept between variants and the passes of --watch
+            p.close()
+            p.join()
+        finally:
+            p.terminate()
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+
+        et = timings["render"][0] - st #tm
+        num_frames = last - first
+        pfps = round(num_frames/et,1)
+        print("Plotted " + str(num_frames) + " frames (" + str(len(j_list)) + " distinct, " + str(len(todo)) + " rendered) in " + str(round(et, 1)) + " seconds (" + str(pfps) + "/s)" + (" to " + out_dir if len(outputs) > 1 else "")) #tm
+        if args['--sheet']:
+            contact_sheet(out_dir, num_frames, os.path.join(out_dir, "contact_sheet.png"))
+            print("Wrote " + os.path.join(out_dir, "contact_sheet.png"))
+        distinct += len(j_list)
+        rendered += len(todo)
+    finish_run(args['--metrics'], module=module, stage="render", frames=num_frames, distinct_frames=distinct, rendered_frames=rendered, threads=threads, variants=len(outputs))
 
 # graph title
 def title(title_format,start_date,delta_days,frames_per_day):
@@ -111,8 +855,7 @@ def get_outdir(out_directory, add_dir=""):
     elif os.path.isfile(out_directory):
         print("\t[!] {} is a File! Please specify an output directory".format(out_directory))
         sys.exit()
-    elif not os.path.exists(os.path.join(out_directory, add_dir)):
-        os.mkdir(os.path.join(out_directory, add_dir))
-        return os.path.abspath(os.path.join(out_directory, add_dir))
     else:
+        # shards started together may create it at the same time
+        os.makedirs(os.path.join(out_directory, add_dir), exist_ok=True)
         return os.path.abspath(os.path.join(out_directory, add_dir))
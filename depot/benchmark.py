@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+"""
+    Usage:
+      animap benchmark -o <DIR> [-m <MODULES>] [-s <SCALES>] [-f <FORMATS>] [-t <THREADS>] [--days <DAYS>] [--seed <SEED>]
+
+    Generates synthetic maps and csv files, compiles and renders them with the region and
+    world modules at several scales and frame formats and writes frames/s, the time of every
+    stage, peak memory and output size to benchmark.json in the output directory.
+
+    Options:
+      -h, --help                    show this
+      -o, --output <DIR>            creates a directory for the inputs, frames and results
+      -m, --modules <MODULES>       comma separated modules to run [default: region,world]
+      -s, --scales <SCALES>         comma separated scales out of small, medium, large [default: small,medium]
+      -f, --formats <FORMATS>       comma separated outputs, png:<level> for a png compression level [default: png]
+      -t, --threads <THREADS>       render processes [default: 2]
+      --days <DAYS>                 date span of every scale instead of its own
+      --seed <SEED>                 seed of the synthetic data [default: 0]
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import yaml
+import shutil
+import platform
+import subprocess
+import numpy as np
+
+from docopt import docopt
+from datetime import date, timedelta
+
+from depot.timeline import Timeline
+from depot.AniMapLib import get_outdir
+
+# days, cases, transfers, milestones and polygons per side of the map grid
+scales = {"small": (60, 300, 60, 5, 10),
+          "medium": (365, 3000, 600, 20, 30),
+          "large": (1460, 20000, 4000, 50, 60)}
+
+start_date = date(2014, 9, 1)
+
+# A grid of quads over bbox with jittered corners, neighbours share their corners
+def grid_polygons(rng, bbox, n):
+    xmin, ymin, xmax, ymax = bbox
+    x, y = np.meshgrid(np.linspace(xmin, xmax, n + 1), np.linspace(ymin, ymax, n + 1))
+    dx, dy = (xmax - xmin) / n, (ymax - ymin) / n
+    x[1:-1, 1:-1] += rng.uniform(-0.3, 0.3, (n - 1, n - 1)) * dx
+    y[1:-1, 1:-1] += rng.uniform(-0.3, 0.3, (n - 1, n - 1)) * dy
+    polygons = []
+    for i in range(n):
+        for j in range(n):
+            ring = [(x[i, j], y[i, j]), (x[i, j+1], y[i, j+1]), (x[i+1, j+1], y[i+1, j+1]), (x[i+1, j], y[i+1, j]), (x[i, j], y[i, j])]
+            polygons.append([[float(a), float(b)] for a, b in ring])
+    return polygons
+
+def write_geojson(path, polygons, properties):
+    features = [{"type": "Feature", "properties": props, "geometry": {"type": "Polygon", "coordinates": [ring]}}
+                for ring, props in zip(polygons, properties)]
+    with open(path, "w") as f:
+        json.dump({"type": "FeatureCollection", "features": features}, f)
+
+def write_csv(path, header, rows):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+def random_dates(rng, n, days):
+    return [start_date + timedelta(days=int(d)) for d in np.sort(rng.integers(0, days, n))]
+
+def synthetic_region(work_dir, rng, days, cases, transfers, milestones, polygons):
+    """Writes region inputs inside the view of the region module and returns their config."""
+    from depot.region import view
+    xmin, ymin, xmax, ymax = view
+    bbox = (xmin + 0.1, ymin + 0.1, xmax - 0.1, ymax - 0.1)
+    municipalities = grid_polygons(rng, bbox, polygons)
+    names = ["MUNICIPALITY %d" % i for i in range(len(municipalities))]
+    write_geojson(os.path.join(work_dir, "municipalities.geojson"), municipalities, [{"name": name} for name in names])
+    write_geojson(os.path.join(work_dir, "regions.geojson"), grid_polygons(rng, bbox, 2), [{"name": "REGION %d" % i} for i in range(4)])
+
+    rows = []
+    for i, day in enumerate(random_dates(rng, cases, days)):
+        rows.append(["ID_%d" % i, day.day, day.month, day.year, rng.choice(["Apiary", "Sentinel", "Natural"]), "", rng.choice(names), "", "",
+                     rng.uniform(bbox[0], bbox[2]), rng.uniform(bbox[1], bbox[3])])
+    write_csv(os.path.join(work_dir, "cases.csv"), ["ID", "Day", "Month", "Year", "Colony", "Locality", "Municipality", "Province", "Region", "Longtitude", "Latitude"], rows)
+    pairs = rng.integers(0, max(cases, 1), (transfers if cases else 0, 2))
+    write_csv(os.path.join(work_dir, "transfers.csv"), ["from", "to"], [["ID_%d" % a, "ID_%d" % b] for a, b in pairs])
+    write_csv(os.path.join(work_dir, "milestones.csv"), ["Day", "Month", "Year", "Text"],
+              [[day.day, day.month, day.year, "%s: milestone %d" % (day, i)] for i, day in enumerate(random_dates(rng, milestones, days))])
+    return {"region_json": "regions.geojson", "municipalities_json": "municipalities.geojson", "region_cases": "cases.csv",
+            "world_transfers_file": "transfers.csv", "milestones": "milestones.csv"}
+
+def synthetic_world(work_dir, rng, days, cases, transfers, milestones, polygons):
+    """Writes world inputs, four regions per country, and returns their config."""
+    cells = grid_polygons(rng, (-180, -60, 180, 80), polygons)
+    countries = ["Country %d" % (i // 4) for i in range(len(cells))]
+    regions = ["Region %d" % i for i in range(len(cells))]
+    write_geojson(os.path.join(work_dir, "world.geojson"), cells, [{"name": c, "r_name": r} for c, r in zip(countries, regions)])
+    centers = [np.mean(ring[:-1], axis=0) for ring in cells]
+    write_csv(os.path.join(work_dir, "centroids.csv"), ["Region", "Latitude", "Longitude"],
+              [[r, lat, lon] for r, (lon, lat) in zip(regions + countries, centers + centers)])
+
+    rows = []
+    for i, day in enumerate(random_dates(rng, cases, days)):
+        cell = int(rng.integers(len(cells)))
+        rows.append(["ID_%d" % i, day.day, day.month, day.year, countries[cell], regions[cell] if rng.random() < 0.5 else "",
+                     int(rng.integers(30, 365)) if rng.random() < 0.5 else ""])
+    write_csv(os.path.join(work_dir, "cases.csv"), ["ID", "Day", "Month", "Year", "Country", "Region", "End"], rows)
+    rows = []
+    for day in random_dates(rng, transfers, days):
+        a, b = rng.integers(len(cells), size=2)
+        rows.append([regions[a], regions[b], day.day, day.month, day.year])
+    write_csv(os.path.join(work_dir, "transfers.csv"), ["from", "to", "Day", "Month", "Year"], rows)
+    return {"world_json": "world.geojson", "world_cases": "cases.csv", "centroids_file": "centroids.csv", "world_transfers_file": "transfers.csv"}
+
+synthetic = {"region": synthetic_region, "world": synthetic_world}
+
+# Bytes of the files in a directory, hardlinked frames once
+def output_size(out_dir):
+    inodes = {}
+    for root, _, files in os.walk(out_dir):
+        for name in files:
+            stat = os.lstat(os.path.join(root, name))
+            inodes[stat.st_ino] = stat.st_size
+    return sum(inodes.values())
+
+# Wall time and peak resident memory of the largest process of a command, in MB
+def run_stage(command, cwd, log_file):
+    st = time.time()
+    with open(log_file, "a") as log:
+        process = subprocess.Popen(command, cwd=cwd, stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    et = time.time() - st
+    if process.returncode != 0:
+        print("\t[!] {} failed, see {}".format(" ".join(command[1:]), log_file))
+        sys.exit()
+    return et, usage.ru_maxrss / 1024
+
+def main():
+    args = docopt(__doc__)
+    out_dir = get_outdir(args['--output'])
+    threads = int(args['--threads'])
+    rng = np.random.default_rng(int(args['--seed']))
+    animap = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "animap")
+
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.yaml")) as stream:
+        base_config = yaml.safe_load(stream)
+
+    runs = []
+    for scale in args['--scales'].split(","):
+        if scale not in scales:
+            print("\t[!] {} is not a scale, use {}".format(scale, ", ".join(scales)))
+            sys.exit()
+        days, cases, transfers, milestones, polygons = scales[scale]
+        days = int(args['--days']) if args['--days'] else days
+        for module in args['--modules'].split(","):
+            if module not in synthetic:
+                print("\t[!] {} is not an animap module".format(module))
+                sys.exit()
+            work_dir = get_outdir(out_dir, "{}_{}".format(module, scale))
+            config = dict(base_config, threads=threads, start_date=start_date, end_date=start_date + timedelta(days=days),
+                          cache_dir=os.path.join(work_dir, "cache"))
+            if module == "world":
+                config["frames_per_day"] = 1
+            config.update(synthetic[module](work_dir, rng, days, cases, transfers, milestones, polygons))
+            with open(os.path.join(work_dir, "config.yaml"), "w") as f:
+                yaml.safe_dump(config, f)
+
+            log_file = os.path.join(work_dir, "animap.log")
+            timeline_file = os.path.join(work_dir, "timeline.npz")
+            command = [sys.executable, animap, module, "-c", "config.yaml"]
+            parse_seconds, parse_rss = run_stage(command + ["-o", work_dir, "--compile", "-t", timeline_file, "-m", "parse_metrics.json"], work_dir, log_file)
+            with open(os.path.join(work_dir, "parse_metrics.json")) as f:
+                parse_stages = json.load(f)["stages"]
+            timeline = Timeline.load(timeline_file)
+            frames = len(timeline.arrays["frames"])
+
+            for output in args['--formats'].split(","):
+                output, _, level = output.partition(":")
+                format_config = dict(config, output=output, png_compression=int(level or 6))
+                with open(os.path.join(work_dir, "config_{}.yaml".format(output + level)), "w") as f:
+                    yaml.safe_dump(format_config, f)
+
+                # every run renders all of its frames
+                frames_dir = os.path.join(work_dir, "frames_" + output + level)
+                shutil.rmtree(frames_dir, ignore_errors=True)
+                render_command = [sys.executable, animap, module, "-c", "config_{}.yaml".format(output + level), "-o", frames_dir]
+                render_seconds, render_rss = run_stage(render_command + ["-t", timeline_file, "-m", "render_metrics.json"], work_dir, log_file)
+                stages = dict(parse_stages)
+                with open(os.path.join(work_dir, "render_metrics.json")) as f:
+                    stages.update(json.load(f)["stages"])
+                size = output_size(frames_dir)
+
+                runs.append({"module": module, "scale": scale, "format": output + (":" + level if level else ""),
+                             "days": days, "cases": cases, "transfers": transfers,
+                             "milestones": milestones, "polygons": polygons ** 2, "frames": frames,
+                             "distinct_frames": len(timeline.arrays["keys"]),
+                             "parse_seconds": round(parse_seconds, 3), "render_seconds": round(render_seconds, 3),
+                             "frames_per_second": round(frames / render_seconds, 2),
+                             "parse_peak_rss_mb": round(parse_rss, 1), "render_peak_rss_mb": round(render_rss, 1),
+                             "output_mb": round(size / 2 ** 20, 1), "stages": stages})
+                print("{} {} {}: {} frames, parsed in {:.1f} s, rendered in {:.1f} s ({:.1f}/s), peak {:.0f} MB, {:.0f} MB of frames".format(
+                    module, scale, runs[-1]["format"], frames, parse_seconds, render_seconds, frames / render_seconds, max(parse_rss, render_rss), size / 2 ** 20))
+
+    results = {"machine": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+               "threads": threads, "seed": int(args['--seed']), "runs": runs}
+    with open(os.path.join(out_dir, "benchmark.json"), "w") as f:
+        json.dump(results, f, indent=2)
+    print("Wrote " + os.path.join(out_dir, "benchmark.json"))
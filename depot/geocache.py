@@ -0,0 +1,72 @@
+import os
+import glob
+import pickle
+import hashlib
+import numpy as np
+
+# Parsed maps are kept here, keyed by the path, modification time and size of their source
+default_cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "animap")
+
+def map_cache_file(path, cache_dir, variant=""):
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    path_key = hashlib.sha1(path.encode()).hexdigest()[:12]
+    version_key = hashlib.sha1("{}:{}".format(stat.st_mtime_ns, stat.st_size).encode()).hexdigest()[:12]
+    if variant:
+        version_key += "-" + hashlib.sha1(variant.encode()).hexdigest()[:12]
+    return os.path.join(cache_dir, "{}-{}-{}.pkl".format(os.path.basename(path), path_key, version_key))
+
+def read_map(path, cache_dir=None, tolerance=None, bbox=None):
+    """GeoDataFrame of a map file, read from the cache while the file is unchanged.
+
+    With a tolerance and/or bbox, the simplified and clipped level of detail of the map
+    is returned instead, cached separately for every tolerance and bbox."""
+    cache_dir = cache_dir or default_cache_dir
+    variant = "" if tolerance is None and bbox is None else repr((tolerance, bbox))
+    cache_file = map_cache_file(path, cache_dir, variant)
+    if os.path.exists(cache_file):
+        try:
+            with open(cache_file, "rb") as f:
+                return pickle.load(f)
+        except Exception:
+            pass
+
+    if variant:
+        data = level_of_detail(read_map(path, cache_dir), tolerance, bbox)
+    else:
+        import geopandas as gpd
+        data = gpd.read_file(path)
+        os.makedirs(cache_dir, exist_ok=True)
+        # drop the cached versions of the previous file
+        current = cache_file[:-len(".pkl")]
+        for old in glob.glob(current.rsplit("-", 1)[0] + "-*.pkl"):
+            if not old.startswith(current):
+                os.remove(old)
+    tmp_file = cache_file + ".%d.tmp" % os.getpid()
+    with open(tmp_file, "wb") as f:
+        pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, cache_file)
+    return data
+
+def lod_tolerance(bbox, pixels, lod_pixels):
+    """Data units spanned by lod_pixels pixels of an axes of pixels (width, height) showing bbox."""
+    xmin, ymin, xmax, ymax = bbox
+    width, height = pixels
+    return lod_pixels * min((xmax - xmin) / width, (ymax - ymin) / height)
+
+def level_of_detail(data, tolerance=None, bbox=None):
+    """Drops the geometries outside bbox, cuts the rest a little beyond it and simplifies them."""
+    from shapely.geometry import box
+    if bbox is not None:
+        xmin, ymin, xmax, ymax = bbox
+        # the cut edges stay outside the axes
+        dx, dy = (xmax - xmin) * 0.05, (ymax - ymin) * 0.05
+        xmin, ymin, xmax, ymax = xmin - dx, ymin - dy, xmax + dx, ymax + dy
+        inside = np.sort(data.sindex.query(box(xmin, ymin, xmax, ymax), predicate="intersects"))
+        data = data.iloc[inside].copy()
+        data["geometry"] = data.geometry.clip_by_rect(xmin, ymin, xmax, ymax)
+    else:
+        data = data.copy()
+    if tolerance:
+        data["geometry"] = data.geometry.simplify(tolerance, preserve_topology=True)
+    return data
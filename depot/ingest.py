@@ -0,0 +1,79 @@
+import csv
+import sys
+import numpy as np
+
+# Rows of a csv file held in memory at once while it is read
+CHUNK_ROWS = 200000
+
+def missing_columns(path, columns):
+    """The columns the header of the csv file at path lacks."""
+    with open(path, newline="") as csvfile:
+        header = next(csv.reader(csvfile), [])
+    return [column for column in columns if column not in header]
+
+def read_chunks(path, columns, chunk_rows=CHUNK_ROWS):
+    """The columns of a csv file as arrays, chunk_rows rows at a time.
+
+    columns maps the names of the columns to read to str or a numeric dtype. Every chunk
+    also holds "row", the line numbers of its rows for error messages."""
+    import pandas as pd
+    missing = missing_columns(path, columns)
+    if missing:
+        print("\t[!] {} has no column {}".format(path, ", ".join(missing)))
+        sys.exit()
+    # numbers are parsed by pandas, columns it cannot parse are checked row by row
+    strings = {name: str for name, dtype in columns.items() if dtype is str}
+    first = 2
+    for chunk in pd.read_csv(path, usecols=list(columns), dtype=strings, na_filter=False, chunksize=chunk_rows):
+        rows = np.arange(first, first + len(chunk))
+        arrays = {"row": rows}
+        for name, dtype in columns.items():
+            values = chunk[name].to_numpy()
+            if dtype is str:
+                arrays[name] = values.astype(str)
+            elif values.dtype.kind in "iu" or (values.dtype.kind == "f" and np.issubdtype(dtype, np.floating)):
+                arrays[name] = values.astype(dtype)
+            else:
+                arrays[name] = to_numbers(values.astype(str), dtype, path, name, rows)
+        first += len(chunk)
+        yield arrays
+
+def to_numbers(values, dtype, path, column, rows):
+    """values of a column as dtype, exits on the first rows that hold no such number."""
+    import pandas as pd
+    numbers = pd.to_numeric(values, errors="coerce").astype(np.float64)
+    bad = ~np.isfinite(numbers)
+    if np.issubdtype(dtype, np.integer):
+        bad |= numbers != np.round(numbers)
+    if bad.any():
+        for row, value in list(zip(rows[bad], values[bad]))[:5]:
+            print("\t[!] {} line {}: {!r} in column {} is not a{} number".format(path, row, str(value), column, "" if np.issubdtype(dtype, np.floating) else " whole"))
+        sys.exit()
+    return numbers.astype(dtype)
+
+def day_offsets(chunk, path, start_date):
+    """Days from start_date to the Year, Month and Day columns of a chunk, exits on impossible dates."""
+    months = (chunk["Year"] - 1970).astype("datetime64[Y]").astype("datetime64[M]") + (chunk["Month"] - 1)
+    days = months.astype("datetime64[D]") + (chunk["Day"] - 1)
+    bad = (chunk["Month"] < 1) | (chunk["Month"] > 12) | (chunk["Day"] < 1) | (days.astype("datetime64[M]") != months)
+    if bad.any():
+        for row, year, month, day in list(zip(chunk["row"][bad], chunk["Year"][bad], chunk["Month"][bad], chunk["Day"][bad]))[:5]:
+            print("\t[!] {} line {}: {}-{}-{} is not a date".format(path, row, year, month, day))
+        sys.exit()
+    return (days - np.datetime64(start_date, "D")).astype(np.int64)
+
+def key_index(keys):
+    """keys sorted, with their positions, for lookup; the last position of repeated keys comes last."""
+    order = np.argsort(keys, kind="stable")
+    return keys[order], order
+
+def lookup(names, index, path, column, rows):
+    """Positions of every name in the keys of key_index, exits on names not among them."""
+    sorted_keys, order = index
+    pos = np.searchsorted(sorted_keys, names, side="right") - 1
+    missing = (pos < 0) | (sorted_keys[np.maximum(pos, 0)] != names) if len(sorted_keys) else np.ones(len(names), dtype=bool)
+    if missing.any():
+        for row, name in list(zip(rows[missing], names[missing]))[:5]:
+            print("\t[!] {} line {}: {} in column {} is unknown".format(path, row, name, column))
+        sys.exit()
+    return order[pos]
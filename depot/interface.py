@@ -7,6 +7,8 @@
   Modules:
     region         animate module for a specific region
     world          animate module for earth
+    merge          checks and joins the frames of sharded renders
+    benchmark      renders synthetic data at several scales and records the throughput
 
   Options
     -h, --help      show this
@@ -27,5 +29,11 @@ def main():
     elif args['<module>'] == 'world':
         import depot.world as world
         world.main()
+    elif args['<module>'] == 'merge':
+        import depot.merge as merge
+        merge.main()
+    elif args['<module>'] == 'benchmark':
+        import depot.benchmark as benchmark
+        benchmark.main()
     else:
         sys.exit("%r is not an animap module. See 'animap -h'." % args['<module>'])
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""
+    Usage:
+      animap merge -o <DIR>
+
+    Checks that the shards rendered to an output directory add up to every frame of
+    the animation, then joins their manifests so later runs resume from all of them.
+
+    Options:
+      -h, --help                    show this
+      -o, --output <DIR>            output directory of the shards
+"""
+
+import os
+import sys
+import json
+import glob
+
+from docopt import docopt
+
+from depot.sinks import MANIFEST, signatures
+
+# Runs of consecutive positions, as first-last
+def ranges(positions):
+    runs = []
+    for f in positions:
+        if runs and runs[-1][1] == f - 1:
+            runs[-1][1] = f
+        else:
+            runs.append([f, f])
+    return ", ".join(str(a) if a == b else "{}-{}".format(a, b) for a, b in runs)
+
+def is_frame(frame_name, format):
+    try:
+        with open(frame_name, "rb") as f:
+            return f.read(len(signatures[format])) == signatures[format]
+    except OSError:
+        return False
+
+def main():
+    args = docopt(__doc__)
+    out_dir = args['--output']
+    if not os.path.isdir(out_dir):
+        print("\t[!] {} is NOT a directory! Please specify the output directory of the shards".format(out_dir))
+        sys.exit()
+
+    shard_files = sorted(glob.glob(os.path.join(out_dir, MANIFEST[:-len(".json")] + ".*-*.json")))
+    manifest_files = shard_files or [os.path.join(out_dir, MANIFEST)]
+    manifests = []
+    for manifest_file in manifest_files:
+        if not os.path.exists(manifest_file):
+            print("\t[!] No frames were rendered to {}".format(out_dir))
+            sys.exit()
+        with open(manifest_file) as f:
+            manifests.append(json.load(f))
+
+    if len(set((m["render"], m.get("format", "png")) for m in manifests)) > 1 or len(set(len(m["frames"]) for m in manifests)) > 1:
+        print("\t[!] The shards in {} were rendered from different configs or maps".format(out_dir))
+        sys.exit()
+
+    num_frames = len(manifests[0]["frames"])
+    format = manifests[0].get("format", "png")
+    frames = [None] * num_frames
+    for m in manifests:
+        for f, key in enumerate(m["frames"]):
+            if key is not None:
+                frames[f] = key
+
+    missing = [f for f in range(num_frames) if frames[f] is None or not is_frame(out_dir + "/frame_%05d.%s"%(f, format), format)]
+    if missing:
+        print("\t[!] {} of {} frames are missing: {}".format(len(missing), num_frames, ranges(missing)))
+        sys.exit()
+
+    # frames past the end of a shorter animation rendered here before
+    for frame_name in glob.glob(out_dir + "/frame_*." + format):
+        if int(os.path.basename(frame_name)[len("frame_"):-len(format) - 1]) >= num_frames:
+            os.remove(frame_name)
+
+    manifest_file = os.path.join(out_dir, MANIFEST)
+    with open(manifest_file + ".tmp", "w") as f:
+        json.dump({"render": manifests[0]["render"], "format": format, "frames": frames}, f)
+    os.replace(manifest_file + ".tmp", manifest_file)
+    for shard_file in shard_files:
+        os.remove(shard_file)
+    print("All {} frames of {} shard(s) are present".format(num_frames, len(manifests)))
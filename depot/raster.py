@@ -0,0 +1,117 @@
+import numpy as np
+
+from functools import lru_cache
+from multiprocessing import shared_memory
+
+from depot.AniMapLib import timer, frame_pixels
+
+# The raster engine paints the fills and points of a frame with NumPy straight into the
+# canvas, through the pixels every patch of the fill layer covers, computed once at the
+# dpi of the frames and shared by all workers. matplotlib only draws what goes over them.
+
+def patch_pixels(fig, collection):
+    """The pixels of fig covered by each patch of collection, as flat indices grouped by patch and the bounds of each group."""
+    from matplotlib.backends.backend_agg import RendererAgg
+    from matplotlib.transforms import Bbox
+    count = len(collection.get_paths())
+    codes = np.arange(1, count + 1)
+    width, height = fig.canvas.get_width_height(physical=True)
+    renderer = RendererAgg(width, height, fig.dpi)
+    # every patch drawn in a color encoding its number, without blending at the edges
+    facecolor, antialiased = collection.get_facecolor(), collection.get_antialiased()
+    collection.set_facecolor(np.stack([codes & 255, codes >> 8 & 255, codes >> 16 & 255], axis=1) / 255)
+    collection.set_antialiased(False)
+    collection.draw(renderer)
+    collection.set_facecolor(facecolor)
+    collection.set_antialiased(antialiased)
+    rgba = np.asarray(renderer.buffer_rgba()).reshape(-1, 4).astype(np.int64)
+    labels = np.where(rgba[:, 3] > 0, rgba[:, 0] | rgba[:, 1] << 8 | rgba[:, 2] << 16, 0)
+    pixels = np.argsort(labels, kind="stable")
+    bounds = np.searchsorted(labels[pixels], np.arange(1, count + 2))
+    # a patch smaller than a pixel covers none and gets the pixel at the center of its extents in view
+    view = Bbox.from_bounds(0, 0, width, height)
+    if collection.get_clip_box() is not None:
+        view = Bbox.intersection(view, collection.get_clip_box())
+    extra = []
+    for n in np.flatnonzero(np.diff(bounds) == 0):
+        extents = Bbox.intersection(collection.get_paths()[n].get_extents(collection.get_transform()), view)
+        if extents is not None:
+            x, y = min(int(extents.x0 + extents.x1) // 2, width - 1), min(int(extents.y0 + extents.y1) // 2, height - 1)
+            extra.append((n + 1, (height - 1 - y) * width + x))
+    if extra:
+        labels = np.concatenate([labels, [code for code, _ in extra]])
+        order = np.argsort(labels, kind="stable")
+        pixels = np.concatenate([np.arange(len(rgba)), [pixel for _, pixel in extra]])[order]
+        bounds = np.searchsorted(labels[order], np.arange(1, count + 2))
+    return {"pixels": pixels[bounds[0]:].astype(np.int32), "bounds": bounds - bounds[0]}
+
+def share(arrays):
+    """Copies arrays into one block of shared memory, returns it and what attach needs to map them."""
+    offsets, size = {}, 0
+    for name, array in arrays.items():
+        offsets[name] = size
+        size += -(-array.nbytes // 8) * 8
+    shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    spec = {}
+    for name, array in arrays.items():
+        np.ndarray(array.shape, array.dtype, buffer=shm.buf, offset=offsets[name])[...] = array
+        spec[name] = (array.dtype.str, array.shape, offsets[name])
+    return shm, (shm.name, spec)
+
+def attach(shared):
+    """The block of shared memory and the arrays in it, see share; the arrays live as long as the block."""
+    name, spec = shared
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, {key: np.ndarray(shape, dtype, buffer=shm.buf, offset=offset) for key, (dtype, shape, offset) in spec.items()}
+
+@lru_cache(maxsize=None)
+def rgb255(color):
+    from matplotlib.colors import to_rgb
+    return np.multiply(to_rgb(color), 255)
+
+def paint_fills(pixels, patches, rgba):
+    """Blends the straight RGBA of every patch, see fill_colors, over the pixels it covers."""
+    painted = np.nonzero(rgba[:, 3] > 0)[0]
+    if len(painted) == 0:
+        return
+    starts = patches["bounds"][painted]
+    counts = patches["bounds"][painted + 1] - starts
+    flat = pixels.reshape(-1, 4)
+    covered = patches["pixels"][np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())]
+    color = np.repeat(rgba[painted], counts, axis=0)
+    under = flat[covered, :3]
+    flat[covered, :3] = under + (color[:, :3] * 255 - under) * color[:, 3:] + 0.5
+
+def paint_points(pixels, ax, points):
+    """Blends each [x, y, markersize, alpha, color] of points as an antialiased dot, in order, clipped to ax."""
+    import matplotlib as mpl
+    height = pixels.shape[0]
+    x, y, size, alpha = [np.array([point[k] for point in points], dtype=float) for k in range(4)]
+    centers = ax.transData.transform(np.column_stack([x, y]))
+    # a marker is its face and an edge of lines.markeredgewidth around it, sizes in points
+    radius = (size + mpl.rcParams["lines.markeredgewidth"]) * ax.figure.dpi / 72 / 2
+    x0, y0, x1, y1 = ax.bbox.extents
+    left, right, top, bottom = int(np.floor(x0)), int(np.ceil(x1)), height - int(np.ceil(y1)), height - int(np.floor(y0))
+    for (cx, cy), r, a, point in zip(centers, radius, alpha, points):
+        cy = height - cy
+        c0, c1 = max(int(cx - r) - 1, left), min(int(cx + r) + 2, right)
+        r0, r1 = max(int(cy - r) - 1, top), min(int(cy + r) + 2, bottom)
+        if c0 >= c1 or r0 >= r1:
+            continue
+        dist = np.hypot(np.arange(c0, c1) + 0.5 - cx, (np.arange(r0, r1) + 0.5 - cy)[:, None])
+        cover = (np.clip(r + 0.5 - dist, 0, 1) * a)[..., None]
+        under = pixels[r0:r1, c0:c1, :3]
+        pixels[r0:r1, c0:c1, :3] = under + (rgb255(point[4]) - under) * cover + 0.5
+
+def composite_frame(fig, background, patches, rgba, ax, points, artists):
+    """draw_frame with the fills and the points of ax painted by NumPy, artists drawn over them by matplotlib."""
+    with timer("frame base"):
+        fig.canvas.restore_region(background)
+    with timer("frame composite"):
+        pixels = frame_pixels(fig)
+        paint_fills(pixels, patches, rgba)
+        if points:
+            paint_points(pixels, ax, points)
+    with timer("frame draw"):
+        for artist in artists:
+            fig.draw_artist(artist)
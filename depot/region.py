@@ -1,44 +1,118 @@
 #!/usr/bin/env python
 """
     Usage:
-      animap region -c <FILE> -o <DIR>
+      animap region -c <FILE> -o <DIR> [-s <SHARD>] [-t <TIMELINE>] [-m <FILE>] [-p <DIR>]
+      animap region -c <FILE> -o <DIR> --compile [-t <TIMELINE>] [-m <FILE>] [-p <DIR>]
+      animap region -c <FILE> --plan [-t <TIMELINE>]
+      animap region -c <FILE> -o <DIR> --preview [--every <DAYS>] [--window <DATES>] [--dpi <DPI>] [--sheet] [-t <TIMELINE>]
+      animap region -c <FILE> -o <DIR> --watch [--interval <SECONDS>] [-m <FILE>]
 
     Options:
       -h, --help                    show this
       -c, --config_file <FILE>      config_file
       -o, --output <DIR>            creates a directory for all output files
+      -s, --shard <SHARD>           renders only shard i/N or output frames first:last, see animap merge
+      -t, --timeline <TIMELINE>     renders a timeline compiled before instead of parsing the csv files
+      --compile                     only compiles the timeline, to <TIMELINE> or timeline.npz in the output directory
+      -m, --metrics <FILE>          writes the time spent in every stage as JSON, or CSV for a .csv file
+      -p, --profile <DIR>           writes a cProfile of the main process and of every worker to <DIR>
+      --plan                        reports the frames, events and estimated render time without rendering
+      --preview                     renders the first frame of every few days at a low dpi with coarse outlines
+      --every <DAYS>                days between preview frames [default: 7]
+      --window <DATES>              previews only the days from:to, as Year-Month-Day:Year-Month-Day, either side optional
+      --dpi <DPI>                   dpi of the preview, half the dpi of the config file by default
+      --sheet                       also tiles the preview frames into contact_sheet.png
+      --watch                       renders again on every change of the config or csv files, only the frames that changed
+      --interval <SECONDS>          seconds between checks of the files watched [default: 2]
 """
 
-import matplotlib as mpl
-import matplotlib.pyplot as plt
-import geopandas as gpd
-import csv
-import sys
-import time
+import os
 import math
 import yaml
+import numpy as np
 
 from docopt import docopt
-from datetime import date, timedelta
-from unidecode import unidecode
-from multiprocessing import Pool
-from matplotlib.gridspec import GridSpec
-from matplotlib.lines import Line2D
-
-from depot.AniMapLib import get_values_curved_line, split, progress, title, remove_frames, get_outdir
-
-
-def fplot(j_list):
-
-    L, Title, i, out_dir, data, data2, dpi = j_list
-
-    municipalities_colors = ["lightskyblue", "#009fff" ,"#0060ff", "#0020ff", "#0000b3"]
-    fig = plt.figure(figsize=(9,6))
+from functools import partial
+
+from depot.timeline import Timeline, read_timeline
+from depot.ingest import CHUNK_ROWS, read_chunks, day_offsets, key_index, lookup
+from depot.raster import attach, composite_frame
+from depot.geocache import read_map, lod_tolerance
+from depot.AniMapLib import render_outputs, watch, unchanged_keys, name_index, match_names, report_unmatched, arc_ids, curved_lines, split, arc_range, title, remove_frames, dedup_frames, timer, start_profile, start_worker_metrics, finish_run, check_config, plan, job_index, get_outdir, cache_background, draw_frame, frame_pixels, axes_pixels, fill_layer, patch_index, fill_colors, recolor
+
+
+# Static base map and geodata of this worker, set once by init_worker
+_base = None
+
+def init_worker(maps, dpi, figure_size, sink, timeline, patches=None, profile_dir=None):
+    global _base
+    start_worker_metrics(profile_dir)
+    with timer("worker setup"):
+        _base = base_map(maps, dpi, figure_size)
+        if isinstance(timeline, str):
+            timeline = Timeline.load(timeline)
+    _base.update({"sink": sink, "timeline": timeline, "patches": None})
+    if patches is not None:
+        _base["shm"], _base["patches"] = attach(patches)
+
+# Events visible on frame t, resolved from the timeline intervals
+def frame_events(timeline, t):
+    params = timeline.params
+    frames_per_day = params["frames_per_day"]
+    L = []
+
+    p = timeline.layers.get("p")
+    for e in timeline.active("p", t):
+        start = p["start"][e]
+        # one dot per decay step still covering this frame, the freshest first
+        for k in range(max(0, t - start - frames_per_day + 1), min(t - start, params["point_decay_frames"] - 1) + 1):
+            markersize = params["point_size"] - k * params["size_decay"]
+            alpha = params["transparency_alpha"] - k * params["transparency_decay"]
+            L.append(["p", p["x"][e], p["y"][e], markersize, alpha, params["colors"][p["color"][e]]])
+
+    counts = timeline.arrays["m_counts"][:, t // frames_per_day]
+    for m_id in np.nonzero(counts)[0]:
+        L.append(["m", timeline.arrays["m_names"][m_id], int(counts[m_id])])
+
+    l = timeline.layers.get("l")
+    nums_end = params["nums_end"]
+    for e in timeline.active("l", t):
+        L.append(["l", int(l["arc"][e]), *arc_range(t - l["center"][e], nums_end)])
+
+    text = timeline.layers.get("t")
+    for e in timeline.active("t", t):
+        L.append(["t", text["text"][e]])
+
+    return L
+
+# Area shown on the map and municipality axes
+view = (14.9, 37.1, 16.6, 39.3)
+
+# Estimated render time of frames in ms: the fixed cost of a frame plus that of its points
+# (drawn for frames_per_day decay steps each), arcs and texts
+def frame_costs(timeline, frames):
+    return (55 + 0.6 * timeline.params["frames_per_day"] * timeline.counts("p", frames)
+            + 5 * timeline.counts("l", frames) + 3 * timeline.counts("t", frames))
+
+def layout(dpi, figure_size=None):
+    import matplotlib.pyplot as plt
+    from matplotlib.gridspec import GridSpec
+    fig = plt.figure(figsize=figure_size or (9,6), dpi=dpi)
     gs = GridSpec(ncols=3,nrows=2,width_ratios=[3.4,1.12,0.1],height_ratios=[2.8,4.4],wspace=0.05)
     ax1 = fig.add_subplot(gs[:,0])
     ax2 = fig.add_subplot(gs[0,1])
     ax3 = fig.add_subplot(gs[1:,1:])
     ax4 = fig.add_subplot(gs[0,2:])
+    return fig, ax1, ax2, ax3, ax4
+
+def base_map(maps, dpi, figure_size=None):
+    import matplotlib as mpl
+    import matplotlib.pyplot as plt
+    from matplotlib.lines import Line2D
+
+    data, data2 = maps
+    municipalities_colors = ["lightskyblue", "#009fff" ,"#0060ff", "#0020ff", "#0000b3"]
+    fig, ax1, ax2, ax3, ax4 = layout(dpi, figure_size)
 
     #Ax1 --points
     data.plot(ax=ax1,edgecolor='darkgrey',facecolor='white',linewidth=.4)
@@ -46,7 +120,7 @@ def fplot(j_list):
     legend_elements=[Line2D([],[],marker="o", markersize=5, color="red", label="Apiary",linewidth=0),
                      Line2D([],[],marker="o", markersize=5, color="purple", label="Sentinel",linewidth=0),
                      Line2D([],[],marker="o", markersize=5, color="orange", label="Natural",linewidth=0)]
-    ax1.legend(handles=legend_elements,loc="lower right", title="Colony")
+    legend = ax1.legend(handles=legend_elements,loc="lower right", title="Colony")
     #Ax2 --municipalities
     data2.plot(ax=ax2,edgecolor='darkgrey',facecolor='white',linewidth=.2)
     ##colorbar
@@ -57,54 +131,87 @@ def fplot(j_list):
     cbar.ax.tick_params(labelsize=7)
     #Ax3 Add text
     ax3.text(0.1,0.9,"Milestones",fontsize=15)
-    text_list= []
     ax3.set_axis_off()
 
     # Title
-    fig.suptitle(Title)
-
-    for frame in L:
-        if frame[0] == "p":
-            ax1.plot(frame[1], frame[2], marker="o", markersize=frame[3], alpha=frame[4], markerfacecolor=frame[5], markeredgecolor=frame[5])
-        elif frame[0] == "l":
-            ax1.plot(frame[1], frame[2], color="black")
-        elif frame[0] == "m":
-            color_index = math.floor(frame[2]/5)
-            if color_index>4:
-                color_index=4
-            data2[data2.name==frame[1]].plot(ax=ax2,color=municipalities_colors[color_index])
-        elif frame[0] == "t":
-            text_list.append(frame[1])
-    h = 0.8
-    for text in text_list:
-        ax3.text(0.1,h,text,fontsize=8)
-        h-=0.05
-
-    ax1.set_xlim([14.9,16.6])
-    ax1.set_ylim([37.1,39.3])
+    suptitle = fig.suptitle("")
+
+    ax1.set_xlim([view[0],view[2]])
+    ax1.set_ylim([view[1],view[3]])
     ax2.set_xlim(ax1.get_xlim())
     ax2.set_ylim(ax1.get_ylim())
     ax2.tick_params(axis="x", which="both", labelbottom=False, bottom=False, top=False)
     ax2.tick_params(axis="y", which="both", labelleft=False, left=False, right=False)
     ax1.set_aspect("auto")
     ax2.set_aspect("auto")
-    plt.text(0.075,0.5,"Sicily",transform=ax1.transAxes)
-    plt.text(0.6,0.77,"Calambria",transform=ax1.transAxes)
-    plt.savefig(out_dir + "/frame_%05d.png"%(i),format="png",dpi=dpi) #dpi=300
-    plt.close()
+    sicily = plt.text(0.075,0.5,"Sicily",transform=ax1.transAxes)
+    calambria = plt.text(0.6,0.77,"Calambria",transform=ax1.transAxes)
 
-def main():
-    args = docopt(__doc__)
-    config_yaml = args['--config_file']
-    out_dir = get_outdir(args['--output'])
+    # Artists drawn above the dynamic layers are redrawn after them
+    overlays = [legend, sicily, calambria] + list(ax1.spines.values()) + list(ax2.spines.values())
+    background = cache_background(fig, overlays)
 
-    # Load config_file
-    stream = open(config_yaml, 'r')
-    config_opts = yaml.safe_load(stream)
-    stream.close()
+    # Municipalities are shaded by recoloring one collection of all of them
+    fills, rows = fill_layer(ax2, data2.geometry)
 
-    threads = config_opts["threads"]
-    dpi = config_opts["dpi"]
+    return {"fig": fig, "ax1": ax1, "ax2": ax2, "ax3": ax3, "suptitle": suptitle, "colors": municipalities_colors,
+            "fills": fills, "fills_index": patch_index(data2.name, rows), "overlays": overlays, "background": background}
+
+def fplot(j_list):
+
+    t, Title, i, dups = j_list
+    with timer("frame events"):
+        L = frame_events(_base["timeline"], t)
+    ax1, ax2, ax3 = _base["ax1"], _base["ax2"], _base["ax3"]
+    municipalities_colors = _base["colors"]
+    fills_index = _base["fills_index"]
+
+    # Title
+    _base["suptitle"].set_text(Title)
+
+    artists = []
+    points = []
+    fills = []
+    text_list= []
+    with timer("frame artists"):
+        for frame in L:
+            if frame[0] == "p" and _base["patches"] is not None:
+                points.append(frame[1:])
+            elif frame[0] == "p":
+                artists += ax1.plot(frame[1], frame[2], marker="o", markersize=frame[3], alpha=frame[4], markerfacecolor=frame[5], markeredgecolor=frame[5])
+            elif frame[0] == "l":
+                x_values, y_values = _base["timeline"].arrays["arcs"][frame[1], :, frame[2]:frame[3]]
+                artists += ax1.plot(x_values, y_values, color="black")
+            elif frame[0] == "m":
+                color_index = math.floor(frame[2]/5)
+                if color_index>4:
+                    color_index=4
+                if frame[1] in fills_index:
+                    fills.append((fills_index[frame[1]], municipalities_colors[color_index], 1))
+            elif frame[0] == "t":
+                text_list.append(frame[1])
+        h = 0.8
+        for text in text_list:
+            artists.append(ax3.text(0.1,h,text,fontsize=8))
+            h-=0.05
+
+    if _base["patches"] is not None:
+        rgba = fill_colors(len(_base["patches"]["bounds"]) - 1, fills)
+        composite_frame(_base["fig"], _base["background"], _base["patches"], rgba, ax1, points, artists + _base["overlays"] + [_base["suptitle"]])
+    else:
+        recolor(_base["fills"], fills)
+        draw_frame(_base["fig"], _base["background"], [_base["fills"]] + artists + _base["overlays"] + [_base["suptitle"]])
+    with timer("frame save"):
+        frame = _base["sink"].render(frame_pixels(_base["fig"]), i, dups)
+    with timer("frame artists"):
+        for artist in artists:
+            artist.remove()
+    return frame
+
+def compile_timeline(config_opts, municipalities, municipalities_index, previous=None):
+    """Built timeline of the cases, transfers and milestones, holding the frames, titles and dedup groups of the animation.
+
+    Frames before the first change from a previous timeline keep its keys instead of being resolved again."""
     title_format = config_opts["title_format_region"]
     frames_per_day = config_opts["frames_per_day"]
     frames_for_line = config_opts["frames_for_line"]
@@ -113,29 +220,9 @@ def main():
     point_decay_days = config_opts["point_decay_days"]
     point_size = config_opts["point_size"]
     transparency_alpha = config_opts["transparency_alpha"]
-
-    region_json = config_opts["region_json"]
-    municipalities_json=config_opts["municipalities_json"]
     region_cases = config_opts["region_cases"]
     region_transfers_file = config_opts["world_transfers_file"]
     milestones = config_opts["milestones"]
-    ##
-
-    st = time.time() #tm
-    data = gpd.read_file(region_json)
-    data2 = gpd.read_file(municipalities_json)
-    municipalities = []
-    municipalities_cases = {}
-    for name in data2.name:
-        municipalities.append(name)
-        municipalities_cases[name] = 0
-
-    et = time.time() - st #tm
-    print("Loaded map in " + str(int(et)) + " seconds.") #tm
-
-    # multiprocessing
-    p = Pool(threads)
-
 
     # point decay
     point_decay_frames = point_decay_days * frames_per_day
@@ -150,158 +237,168 @@ def main():
     Title=title(title_format,start_date,delta_days,frames_per_day)
 
 
-    L=[[] for x in range(limit)]
-    points = {}
-
-    st = time.time() #tm
-    with open(region_cases) as csvfile:
-        reader = csv.reader(csvfile,delimiter=",")
-        for row in reader:
-            i_id = row.index('ID')
-            i_longtitude = row.index('Longtitude')
-            i_latitude = row.index('Latitude')
-            i_colony = row.index('Colony')
-            i_day = row.index('Day')
-            i_month = row.index('Month')
-            i_year = row.index('Year')
-            i_municipality = row.index('Municipality')
-            break
-
-        for row in reader:
-            longtitude = float(row[i_longtitude])
-            latitude = float(row[i_latitude])
-            id_name = row[i_id]
-            municipality = row[i_municipality]
-            points[id_name] ={}
-            points[id_name]["loc"] = [longtitude,latitude]
-            point_date = date(int(row[i_year]),int(row[i_month]),int(row[i_day]))
-            delta = point_date - start_date
-            start = delta.days * frames_per_day
-            points[id_name]["start"] = start
-            end = start + point_decay_frames
-
-            if end == "":
-                end = limit
-            else:
-                end = int(end)
-
-            ##### municipalities
-            found = 0
-            for name in municipalities:
-                if unidecode(name.lower()) == unidecode(municipality.lower()):
-                    municipalities_cases[name] += 1
-                    found = 1
-                    for f in range(limit - start):
-                        l_index = 0
-                        m_found = 0
-                        while l_index < len(L[start+f]):
-                            if L[start+f][l_index][0] == "m" and L[start+f][l_index][1] == name:
-                                L[start+f][l_index][2] += 1
-                                m_found = 1
-                            l_index += 1
-
-                        if not m_found:
-                            loc = ["m",name,1]
-                            L[start+f].append(loc)
-
-            #check_errors
-            if not found:
-                print(municipality)
+    # the title settings are kept so a compiled timeline is titled as it was compiled, see read_timeline
+    timeline = Timeline(limit, title_format=title_format, start_date=start_date.isoformat(),
+                        colors=["red", "purple", "orange"], frames_per_day=frames_per_day, point_decay_frames=point_decay_frames,
+                        point_size=point_size, size_decay=size_decay,
+                        transparency_alpha=transparency_alpha, transparency_decay=transparency_decay,
+                        nums_end=split(30,frames_for_line))
+    unmatched = {}
+    municipalities_cases = np.zeros((len(municipalities), delta_days), dtype=np.int32)
+    chunk_rows = config_opts.get("chunk_rows", CHUNK_ROWS)
+
+    # location and first frame of every case, for the transfers
+    ids, xs, ys, starts = [], [], [], []
+    with timer("parse cases", "Parsed points file in {:.2f} seconds."):
+        columns = {"ID": str, "Longtitude": np.float32, "Latitude": np.float32, "Colony": str,
+                   "Day": np.int32, "Month": np.int32, "Year": np.int32, "Municipality": str}
+        for chunk in read_chunks(region_cases, columns, chunk_rows):
+            days = day_offsets(chunk, region_cases, start_date)
+            start = days * frames_per_day
+            ids.append(chunk["ID"])
+            xs.append(chunk["Longtitude"])
+            ys.append(chunk["Latitude"])
+            starts.append(start)
+
+            ##### municipalities, cases per day, cases before the start on its first day
+            distinct, found, inverse = match_names(municipalities_index, chunk["Municipality"], unmatched)
+            counted = days < delta_days
+            day_cases = np.bincount(inverse[counted] * delta_days + np.maximum(days[counted], 0),
+                                    minlength=len(distinct) * delta_days).reshape(len(distinct), delta_days)
+            for u, m_ids in enumerate(found):
+                for m_id in m_ids:
+                    municipalities_cases[m_id] += day_cases[u]
             #####
-            markersize = point_size
-            alpha = transparency_alpha
-
-            if row[i_colony] == "Sentinel":
-                color = "purple"
-            elif row[i_colony] == "Natural":
-                color = "orange"
-            else:
-                color = "red"
-
-            while start < end and start < limit and delta.days>=0:
-
-                for f in range(frames_per_day):
-                    loc = ["p",longtitude,latitude,markersize,alpha,color]
-                    L[start+f].append(loc)
-
-                start += 1
-                markersize -= size_decay
-                alpha -= transparency_decay
-
-
-    et = time.time() - st #tm
-    print("Parsed points file in " + str(int(et)) + " seconds.") #tm
-
-    st = time.time() #tm
-    with open(region_transfers_file) as csvfile:
-        reader = csv.reader(csvfile,delimiter=",")
-        for row in reader:
-            i_from = row.index('from')
-            i_to = row.index('to')
-            break
-
-        for row in reader:
-            start = points[row[i_to]]["start"]
-            if start < limit: #GK still if too early or too late
-                x_values, y_values = get_values_curved_line(points[row[i_from]]["loc"],points[row[i_to]]["loc"])
-                nums_end = split(len(x_values),frames_for_line)
-                values = [x_values,y_values]
-                L[start].append(["l",x_values,y_values])
-                for i in range(frames_for_line-1):
-                    diff = i + 1
-                    sdiff = frames_for_line - diff
-                    loc = ["l", x_values[:nums_end[i]], y_values[:nums_end[i]]]
-                    L[start-sdiff].append(loc)
-                    loc = ["l", x_values[nums_end[i]:nums_end[-1]],y_values[nums_end[i]:nums_end[-1]]]
-                    L[start+diff].append(loc)
-
-    et = time.time() - st #tm
-    print("Parsed transfers file in " + str(int(et)) + " seconds.") #tm
-
-
-    st = time.time() #tm
-    with open(milestones) as csvfile:
-        reader = csv.reader(csvfile,delimiter=",")
-        for row in reader:
-            i_day = row.index('Day')
-            i_month = row.index('Month')
-            i_year = row.index('Year')
-            i_text = row.index('Text')
-            break
-
-        for row in reader:
-            point_date = date(int(row[i_year]),int(row[i_month]),int(row[i_day]))
-            delta = point_date - start_date
-            start = delta.days * frames_per_day
-            while start < limit and delta.days>=0:
-                for f in range(frames_per_day):
-                    loc = ["t",row[i_text]]
-                    L[start+f].append(loc)
-
-                start += frames_per_day
-
-    et = time.time() - st #tm
-    print("Parsed milestones file in " + str(int(et)) + " seconds.") #tm
 
+            # colors by colony, any other colony is drawn as an apiary
+            color = np.where(chunk["Colony"] == "Sentinel", 1, np.where(chunk["Colony"] == "Natural", 2, 0)).astype(np.uint8)
+
+            # each frame of the decay draws the point on the following frames_per_day frames
+            cased = days >= 0
+            timeline.extend("p", start[cased], start[cased] + point_decay_frames + frames_per_day - 1,
+                            x=chunk["Longtitude"][cased], y=chunk["Latitude"][cased], color=color[cased])
+    ids, xs, ys, starts = [np.concatenate(col) if col else np.array([], dtype=dtype)
+                           for col, dtype in ((ids, str), (xs, np.float32), (ys, np.float32), (starts, np.int64))]
+
+    #check_errors
+    report_unmatched(unmatched, "municipality")
+
+    arcs = {}
+    index = key_index(ids)
+    with timer("parse transfers", "Parsed transfers file in {:.2f} seconds."):
+        for chunk in read_chunks(region_transfers_file, {"from": str, "to": str}, chunk_rows):
+            to = lookup(chunk["to"], index, region_transfers_file, "to", chunk["row"])
+            start = starts[to]
+            drawn = start < limit #GK still if too early or too late
+            to, start = to[drawn], start[drawn]
+            frm = lookup(chunk["from"][drawn], index, region_transfers_file, "from", chunk["row"][drawn])
+            # the arc is drawn in over the frames before the case and out over the frames after
+            kept = (np.maximum(start - frames_for_line + 1, 0) < np.minimum(start + frames_for_line, limit))
+            to, frm, start = to[kept], frm[kept], start[kept]
+            arc = arc_ids(arcs, np.stack([xs[frm], ys[frm], xs[to], ys[to]], axis=1))
+            timeline.extend("l", start - frames_for_line + 1, start + frames_for_line, arc=arc, center=start)
+    # one arc per pair of endpoints, computed all at once
+    timeline.arrays["arcs"] = curved_lines(np.array(list(arcs), dtype=float).reshape(len(arcs), 2, 2))
+
+    with timer("parse milestones", "Parsed milestones file in {:.2f} seconds."):
+        columns = {"Day": np.int32, "Month": np.int32, "Year": np.int32, "Text": str}
+        for chunk in read_chunks(milestones, columns, chunk_rows):
+            start = day_offsets(chunk, milestones, start_date) * frames_per_day
+            shown = start >= 0
+            timeline.extend("t", start[shown], np.full(shown.sum(), limit), text=chunk["Text"][shown])
+
+    with timer("timeline build"):
+        timeline.build()
+
+    # Running count of cases per municipality and day, kept for municipalities with cases
+    municipalities_cases = np.cumsum(municipalities_cases, axis=1)
+    cased = np.nonzero(municipalities_cases[:, -1])[0] if delta_days else []
+    timeline.arrays["m_names"] = np.array(municipalities, dtype=str)[cased]
+    timeline.arrays["m_counts"] = municipalities_cases[cased]
 
     # Scale to 1 frame empty days of ax1
-    L,Title = remove_frames(L,Title,limit,frames_per_day)
-
-
-    #Plotting the frames
-    st = time.time() #tm
-    j_list=[]
-    for i in range(len(Title)):
-        j = [L[i],Title[i],i,out_dir, data, data2, dpi]
-        j_list.append(j)
+    frames = remove_frames(timeline.coverage("p", "l"),limit,frames_per_day)
+
+    # Frames with the same content are rendered once
+    with timer("dedup"):
+        known = unchanged_keys(previous, timeline, frames, [Title[t] for t in frames], ("m_names", "m_counts"))
+        j_list, keys = dedup_frames(frames, [Title[t] for t in frames], partial(frame_events, timeline), known, config_opts["threads"])
+    if previous is not None:
+        print("Kept {} of {} frames from the last pass".format(len(known), len(frames)))
+    timeline.arrays["module"] = np.array("region")
+    timeline.arrays["frames"] = np.array(frames, dtype=np.int64)
+    timeline.arrays["titles"] = np.array([Title[t] for t in frames], dtype=str)
+    timeline.arrays["job_of"] = job_index(j_list, len(frames))
+    timeline.arrays["keys"] = np.array(keys, dtype=str)
+    return timeline
+
+# The maps cut to the view and simplified to lod_pixels of a pixel, as full maps for 0
+def draw_maps(config_opts, data, data2, dpi, figure_size, lod_pixels):
+    if not lod_pixels:
+        return data, data2
+    import matplotlib.pyplot as plt
+    cache_dir = config_opts.get("cache_dir")
+    fig, ax1, ax2, _, _ = layout(dpi, figure_size)
+    draw_data = read_map(config_opts["region_json"], cache_dir, lod_tolerance(view, axes_pixels(ax1), lod_pixels), view)
+    draw_data2 = read_map(config_opts["municipalities_json"], cache_dir, lod_tolerance(view, axes_pixels(ax2), lod_pixels), view)
+    plt.close(fig)
+    return draw_data, draw_data2
+
+def run(args, previous=None):
+    """One run of the command line, returns the timeline; previous is the timeline of the last run of --watch."""
+    config_yaml = args['--config_file']
+    out_dir = None if args['--plan'] else get_outdir(args['--output'])
 
-    i=0
-    for i, _ in enumerate(p.imap_unordered(fplot,j_list),1):
-        progress(i,1,len(j_list))
+    # Load config_file
+    stream = open(config_yaml, 'r')
+    config_opts = yaml.safe_load(stream)
+    stream.close()
+    parse = args['--compile'] or not args['--timeline']
+    check_config(config_opts, "region", parse)
 
+    threads = config_opts["threads"]
+    region_json = config_opts["region_json"]
+    municipalities_json=config_opts["municipalities_json"]
+    name_aliases = config_opts.get("name_aliases")
+    cache_dir = config_opts.get("cache_dir")
+    ##
 
+    if args['--profile']:
+        start_profile(args['--profile'], "main")
+
+    # a plan of a compiled timeline needs no maps
+    if parse or not args['--plan']:
+        with timer("map load", "Loaded map in {:.2f} seconds."):
+            data = read_map(region_json, cache_dir)
+            data2 = read_map(municipalities_json, cache_dir)
+
+    if parse:
+        municipalities = []
+        for name in data2.name:
+            municipalities.append(name)
+        timeline = compile_timeline(config_opts, municipalities, name_index(municipalities, name_aliases), previous)
+        if args['--compile']:
+            timeline_file = args['--timeline'] or os.path.join(out_dir, "timeline.npz")
+            with timer("timeline save"):
+                timeline.save(timeline_file)
+            print("Compiled timeline to " + timeline_file)
+            finish_run(args['--metrics'], module="region", stage="compile", frames=len(timeline.arrays["frames"]))
+            return timeline
+        worker_timeline = timeline
+    else:
+        # every worker maps the compiled timeline from the file instead of receiving a copy
+        timeline = read_timeline(args['--timeline'], "region", config_opts)
+        worker_timeline = args['--timeline']
+    if args['--plan']:
+        plan(timeline, threads, frame_costs)
+        return timeline
+    # Every variant of the output renders the same maps and timeline, see render_outputs
+    render_outputs(args, config_opts, out_dir, "region", timeline, worker_timeline, partial(draw_maps, config_opts, data, data2), base_map, init_worker, fplot, frame_costs, (region_json, municipalities_json))
+    return timeline
 
-    et = time.time() - st #tm
-    num_frames = len(j_list)
-    pfps = round(num_frames/et,1)
-    print("Plotted " + str(num_frames) + " frames in " + str(int(et)) + " seconds (" + str(pfps) + "/s)") #tm
+def main():
+    args = docopt(__doc__)
+    if args['--watch']:
+        watch(args['--config_file'], "region", partial(run, args), float(args['--interval']))
+    else:
+        run(args)
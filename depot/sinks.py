@@ -0,0 +1,355 @@
+import os
+import sys
+import json
+import zlib
+import time
+import shutil
+import importlib.util
+import subprocess
+import numpy as np
+
+from depot.AniMapLib import timer
+
+# Where rendered frames go. Before rendering, resume() drops the jobs whose frames
+# the sink already holds. Workers call render() with the pixels of a frame, its
+# output position and the later positions showing the same frame; whatever it
+# returns is passed to write() in the main process as the frames finish. Ordered
+# sinks get the jobs one at a time in output order and reorder the few in flight.
+
+MANIFEST = "animap_manifest.json"
+RAW_FRAMES = "frames.raw"
+RAW_INDEX = "frames.json"
+
+def manifest_name(first, last):
+    return "animap_manifest.%05d-%05d.json" % (first, last)
+
+# Signature every frame file of a format starts with
+signatures = {"png": b"\x89PNG\r\n\x1a\n", "bmp": b"BM", "ppm": b"P6"}
+
+class ImageFrames:
+    """frame_%05d.<format> files in the output directory, repeated frames as hardlinks, symlinks or copies.
+
+    png files are compressed at compression, 0 to 9; bmp and ppm files hold the plain pixels."""
+    ordered = False
+
+    def __init__(self, out_dir, dpi, duplicates="hardlink", format="png", compression=6):
+        self.out_dir = out_dir
+        self.dpi = dpi
+        self.duplicates = duplicates
+        self.format = format
+        self.compression = compression
+        # content key of the frame at each output position, see dedup_frames
+        self.manifest = {"render": None, "format": format, "frames": []}
+        self.manifest_file = os.path.join(out_dir, MANIFEST)
+        self.pending = {}
+        self.flushed = 0
+
+    def frame_name(self, f):
+        return self.out_dir + "/frame_%05d.%s"%(f, self.format)
+
+    def resume(self, j_list, keys, render_key, num_frames, first=0, last=None):
+        """Jobs whose frames are missing or were rendered from other content or settings.
+
+        keys holds the content key of each job; render_key the settings every frame depends on.
+        A shard of positions [first, last) keeps its own manifest until the shards are merged."""
+        last = num_frames if last is None else last
+        sharded = (first, last) != (0, num_frames)
+        self.manifest_file = os.path.join(self.out_dir, manifest_name(first, last) if sharded else MANIFEST)
+        for manifest_file in (self.manifest_file, os.path.join(self.out_dir, MANIFEST)):
+            if os.path.exists(manifest_file):
+                with open(manifest_file) as f:
+                    self.manifest = json.load(f)
+                break
+        if self.manifest["render"] != render_key or self.manifest.get("format", "png") != self.format:
+            self.manifest = {"render": render_key, "format": self.format, "frames": []}
+        frames = self.manifest["frames"]
+
+        if not sharded:
+            # frames past the end of a shorter animation
+            for f in range(num_frames, len(frames)):
+                if os.path.lexists(self.frame_name(f)):
+                    os.remove(self.frame_name(f))
+        frames = frames[:num_frames] + [None] * (num_frames - len(frames))
+        frames = [None] * first + frames[first:last] + [None] * (num_frames - last)
+
+        todo = []
+        for j, key in zip(j_list, keys):
+            positions = [j[2]] + list(j[3])
+            if any(frames[f] != key or not os.path.exists(self.frame_name(f)) for f in positions):
+                todo.append(j)
+                self.pending[j[2]] = (positions, key)
+                # a crash while rendering must not leave an old key on a new frame
+                for f in positions:
+                    frames[f] = None
+        self.manifest["frames"] = frames
+        self.flush()
+        return todo
+
+    def flush(self):
+        with open(self.manifest_file + ".tmp", "w") as f:
+            json.dump(self.manifest, f)
+        os.replace(self.manifest_file + ".tmp", self.manifest_file)
+        self.flushed = time.time()
+
+    def render(self, rgba, i, dups=()):
+        frame_name = self.frame_name(i)
+        # never write through a link left by an earlier run
+        if os.path.lexists(frame_name):
+            os.remove(frame_name)
+        if self.format == "png":
+            from matplotlib.image import imsave
+            imsave(frame_name, rgba, format="png", dpi=self.dpi, pil_kwargs={"compress_level": self.compression})
+        else:
+            from PIL import Image
+            Image.fromarray(np.ascontiguousarray(rgba[..., :3])).save(frame_name, format=self.format.upper())
+        for f in dups:
+            same_frame(frame_name, self.frame_name(f), self.duplicates)
+        return i
+
+    def write(self, frame):
+        positions, key = self.pending.pop(frame)
+        for f in positions:
+            self.manifest["frames"][f] = key
+        if time.time() - self.flushed > 2:
+            self.flush()
+
+    def close(self):
+        self.flush()
+
+class RawFrames:
+    """Every distinct frame once, as raw RGB, in frames.raw; frames.json maps output positions to them.
+
+    Workers write their frames straight into their slots of the file, see raw_frames to map it."""
+    ordered = False
+
+    def __init__(self, out_dir):
+        self.raw_file = os.path.join(out_dir, RAW_FRAMES)
+        self.index_file = os.path.join(out_dir, RAW_INDEX)
+        self.slots = {}
+        self.frames = []
+        self.shape = None
+        self.fd = None
+
+    def resume(self, j_list, keys, render_key, num_frames, first=0, last=None):
+        # the raw file is always written whole, the workers forked after this know the slots
+        if (first, last) not in ((0, None), (0, num_frames)):
+            print("\t[!] shards are rendered as image frames, not as a raw file")
+            sys.exit()
+        self.slots = {j[2]: n for n, j in enumerate(j_list)}
+        self.frames = [None] * num_frames
+        for n, j in enumerate(j_list):
+            for f in [j[2]] + list(j[3]):
+                self.frames[f] = n
+        for name in (self.raw_file, self.index_file):
+            if os.path.exists(name):
+                os.remove(name)
+        return j_list
+
+    def render(self, rgba, i, dups=()):
+        rgb = np.ascontiguousarray(rgba[..., :3])
+        if self.fd is None:
+            self.fd = os.open(self.raw_file, os.O_WRONLY | os.O_CREAT, 0o644)
+        os.pwrite(self.fd, rgb.data, self.slots[i] * rgb.nbytes)
+        return rgb.shape
+
+    def write(self, shape):
+        self.shape = shape
+
+    def close(self):
+        if self.shape is None:
+            return
+        height, width, channels = self.shape
+        with open(self.index_file, "w") as f:
+            json.dump({"width": width, "height": height, "channels": channels, "frames": self.frames}, f)
+
+    def __getstate__(self):
+        # every worker opens the file itself
+        state = self.__dict__.copy()
+        state["fd"] = None
+        return state
+
+class VideoFrames:
+    """One video, every distinct frame encoded once and shown for as long as it is held.
+
+    Frames are encoded in the main process as they arrive, through PyAV with the timestamp of
+    their first position, so a held frame lasts until the next one (variable frame rate).
+    Without PyAV they are piped as raw RGB to ffmpeg, a held frame sent again for every position.
+    Frames shown again after others are kept zlib compressed until their last run."""
+    ordered = True
+
+    def __init__(self, video_file, fps, ffmpeg, codec):
+        self.video_file = video_file
+        self.fps = fps
+        self.ffmpeg = ffmpeg
+        self.codec = codec
+        self.encoder = None
+        # job of every output position, by its first position, and the last position of every job
+        self.frames = []
+        self.last = {}
+        # frames received ahead of the position being encoded, and those shown again later
+        self.waiting = {}
+        self.kept = {}
+        self.position = 0
+
+    def __getstate__(self):
+        # workers only render
+        state = dict(self.__dict__)
+        state.update(encoder=None, frames=[], last={}, waiting={}, kept={})
+        return state
+
+    def resume(self, j_list, keys, render_key, num_frames, first=0, last=None):
+        # a video is always encoded whole
+        if (first, last) not in ((0, None), (0, num_frames)):
+            print("\t[!] shards are rendered as png frames, not as video")
+            sys.exit()
+        self.frames = [None] * num_frames
+        for t, Title, i, dups in j_list:
+            for f in [i] + list(dups):
+                self.frames[f] = i
+            self.last[i] = max([i] + list(dups))
+        return j_list
+
+    def render(self, rgba, i, dups=()):
+        return i, np.ascontiguousarray(rgba[..., :3])
+
+    def write(self, frame):
+        i, rgb = frame
+        self.waiting[i] = rgb
+        while self.position < len(self.frames):
+            job = self.frames[self.position]
+            if job in self.waiting:
+                rgb = self.waiting.pop(job)
+            elif job in self.kept:
+                shape, data = self.kept.pop(job)
+                rgb = np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(shape)
+            else:
+                break
+            end = self.position + 1
+            while end < len(self.frames) and self.frames[end] == job:
+                end += 1
+            if self.last[job] >= end:
+                self.kept[job] = (rgb.shape, zlib.compress(rgb.tobytes(), 1))
+            self.encode(rgb, self.position, end - self.position)
+            self.position = end
+
+    def encode(self, rgb, position, count):
+        with timer("encode"):
+            if self.encoder is None:
+                self.open(*rgb.shape[:2])
+            if self.ffmpeg is not None:
+                data = rgb.tobytes()
+                for _ in range(count):
+                    self.encoder.stdin.write(data)
+                return
+            import av
+            from fractions import Fraction
+            container, stream = self.encoder
+            height, width = rgb.shape[:2]
+            # yuv420p needs an even width and height
+            rgb = np.pad(rgb, ((0, height % 2), (0, width % 2), (0, 0)))
+            # the last frame is sent again at the last position, which ends the video
+            for pts in [position] + ([position + count - 1] if count > 1 and position + count == len(self.frames) else []):
+                video_frame = av.VideoFrame.from_ndarray(rgb, format="rgb24")
+                video_frame.pts, video_frame.time_base = pts, Fraction(1, self.fps)
+                for packet in stream.encode(video_frame):
+                    container.mux(packet)
+
+    def open(self, height, width):
+        if self.ffmpeg is not None:
+            command = [self.ffmpeg, "-y", "-loglevel", "error", "-f", "rawvideo", "-pix_fmt", "rgb24",
+                       "-s", "{}x{}".format(width, height), "-r", str(self.fps), "-i", "-",
+                       "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2", "-c:v", self.codec, "-pix_fmt", "yuv420p", self.video_file]
+            self.encoder = subprocess.Popen(command, stdin=subprocess.PIPE)
+            return
+        import av
+        from fractions import Fraction
+        container = av.open(self.video_file, "w")
+        stream = container.add_stream(self.codec, rate=self.fps)
+        stream.width, stream.height = width + width % 2, height + height % 2
+        stream.pix_fmt = "yuv420p"
+        stream.time_base = Fraction(1, self.fps)
+        self.encoder = (container, stream)
+
+    def close(self):
+        if self.encoder is None:
+            return
+        with timer("encode"):
+            if self.ffmpeg is not None:
+                self.encoder.stdin.close()
+                failed = self.encoder.wait() != 0
+            else:
+                container, stream = self.encoder
+                for packet in stream.encode():
+                    container.mux(packet)
+                container.close()
+                failed = False
+        self.encoder = None
+        if failed:
+            print("\t[!] ffmpeg failed to encode {}".format(self.video_file))
+            sys.exit()
+        if self.position < len(self.frames):
+            print("\t[!] {} ends at position {} of {}, the frames after it never arrived".format(self.video_file, self.position, len(self.frames)))
+            sys.exit()
+
+def same_frame(frame_name, same_frame_name, duplicates):
+    if os.path.lexists(same_frame_name):
+        os.remove(same_frame_name)
+    try:
+        if duplicates == "hardlink":
+            os.link(frame_name, same_frame_name)
+            return
+        elif duplicates == "symlink":
+            os.symlink(os.path.basename(frame_name), same_frame_name)
+            return
+    except OSError:
+        pass
+    shutil.copyfile(frame_name, same_frame_name)
+
+def find_ffmpeg(ffmpeg):
+    if shutil.which(ffmpeg):
+        return shutil.which(ffmpeg)
+    try:
+        import imageio_ffmpeg
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except ImportError:
+        return None
+
+def get_sink(config_opts, out_dir, dpi):
+    """The frame sink selected by the output option of the config."""
+    output = config_opts.get("output", "png")
+    if output in signatures:
+        return ImageFrames(out_dir, dpi, config_opts.get("duplicate_frames", "hardlink"), output, config_opts.get("png_compression", 6))
+    elif output == "raw":
+        return RawFrames(out_dir)
+    elif output == "video":
+        # encoded through PyAV if installed, otherwise piped to ffmpeg
+        ffmpeg = None
+        if importlib.util.find_spec("av") is None:
+            ffmpeg = find_ffmpeg(config_opts.get("ffmpeg", "ffmpeg"))
+            if ffmpeg is None:
+                print("\t[!] Neither PyAV nor ffmpeg was found, one of them is needed for video output")
+                sys.exit()
+        video_file = os.path.join(out_dir, config_opts.get("video_file", "animation.mp4"))
+        return VideoFrames(video_file, config_opts.get("fps", 25), ffmpeg, config_opts.get("video_codec", "libx264"))
+    else:
+        print("\t[!] {} is not an output, use png, bmp, ppm, raw or video".format(output))
+        sys.exit()
+
+def raw_frames(out_dir):
+    """The frames of a raw file written to out_dir mapped as an array of (slots, height, width, 3), and the slot of every output position."""
+    with open(os.path.join(out_dir, RAW_INDEX)) as f:
+        index = json.load(f)
+    frames = np.memmap(os.path.join(out_dir, RAW_FRAMES), dtype=np.uint8, mode="r")
+    return frames.reshape(-1, index["height"], index["width"], index["channels"]), index["frames"]
+
+def contact_sheet(out_dir, num_frames, sheet_file, columns=8):
+    """Tiles the png frames of the output directory into one image, row by row."""
+    from matplotlib.image import imread, imsave
+    tiles = [imread(out_dir + "/frame_%05d.png"%(f)) for f in range(num_frames)]
+    height, width, depth = tiles[0].shape
+    columns = min(columns, len(tiles))
+    sheet = np.ones((-(-len(tiles) // columns) * height, columns * width, depth), dtype=tiles[0].dtype)
+    for n, tile in enumerate(tiles):
+        row, column = divmod(n, columns)
+        sheet[row*height:(row+1)*height, column*width:(column+1)*width] = tile
+    imsave(sheet_file, sheet)
@@ -0,0 +1,141 @@
+import os
+import sys
+import json
+import zipfile
+import numpy as np
+
+class Timeline:
+    """Events stored once as [start, end) frame intervals, resolved per frame on demand."""
+
+    def __init__(self, limit, **params):
+        self.limit = limit
+        self.params = params
+        self.layers = {}
+        self.arrays = {}
+        self._chunks = {}
+
+    def extend(self, layer, start, end, **columns):
+        """Queues events given as arrays of equal length, clipped to the frames of the animation; returns which were kept."""
+        start = np.maximum(start, 0)
+        end = np.minimum(end, self.limit)
+        kept = start < end
+        chunk = {"start": start[kept], "end": end[kept]}
+        for name, col in columns.items():
+            chunk[name] = np.asarray(col)[kept]
+        self._chunks.setdefault(layer, []).append(chunk)
+        return kept
+
+    def build(self):
+        """Packs the queued events of each layer into columns sorted by start frame."""
+        for layer, chunks in self._chunks.items():
+            start = np.concatenate([chunk["start"] for chunk in chunks]).astype(np.int64)
+            if len(start) == 0:
+                continue
+            order = np.argsort(start, kind="stable")
+            cols = {"start": start[order],
+                    "end": np.concatenate([chunk["end"] for chunk in chunks]).astype(np.int64)[order],
+                    "order": order}
+            for name in chunks[0]:
+                if name not in cols:
+                    cols[name] = np.concatenate([chunk[name] for chunk in chunks])[order]
+            cols["span"] = int((cols["end"] - cols["start"]).max())
+            self.layers[layer] = cols
+        self._chunks = {}
+        return self
+
+    def active(self, layer, frame):
+        """Indices of the events of a layer covering frame, in the order they were added."""
+        if layer not in self.layers:
+            return np.array([], dtype=np.int64)
+        cols = self.layers[layer]
+        hi = np.searchsorted(cols["start"], frame, side="right")
+        lo = np.searchsorted(cols["start"], frame - cols["span"] + 1, side="left")
+        idx = lo + np.nonzero(cols["end"][lo:hi] > frame)[0]
+        return idx[np.argsort(cols["order"][idx])]
+
+    def counts(self, layer, frames):
+        """Number of events of a layer covering each of frames."""
+        if layer not in self.layers:
+            return np.zeros(len(frames), dtype=np.int64)
+        cols = self.layers[layer]
+        return np.searchsorted(cols["start"], frames, side="right") - np.searchsorted(np.sort(cols["end"]), frames, side="right")
+
+    def coverage(self, *layers):
+        """Per frame, whether any event of the given layers is visible."""
+        diff = np.zeros(self.limit + 1, dtype=np.int64)
+        for layer in layers:
+            if layer in self.layers:
+                np.add.at(diff, self.layers[layer]["start"], 1)
+                np.add.at(diff, self.layers[layer]["end"], -1)
+        return np.cumsum(diff[:-1]) > 0
+
+    def save(self, path):
+        """Writes the built timeline to an uncompressed .npz file, see load."""
+        arrays = {"limit": np.array(self.limit), "params": np.array(json.dumps(self.params))}
+        for layer, cols in self.layers.items():
+            for name, col in cols.items():
+                arrays["layers/{}/{}".format(layer, name)] = np.asarray(col)
+        for name, array in self.arrays.items():
+            arrays["arrays/" + name] = np.asarray(array)
+        with open(path + ".tmp", "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        """A timeline written by save, its arrays memory-mapped from the file."""
+        arrays = load_npz(path)
+        timeline = cls(int(arrays.pop("limit")), **json.loads(str(arrays.pop("params"))))
+        for key, array in arrays.items():
+            kind, name = key.split("/", 1)
+            if kind == "layers":
+                layer, name = name.split("/")
+                timeline.layers.setdefault(layer, {})[name] = int(array) if name == "span" else array
+            else:
+                timeline.arrays[name] = array
+        return timeline
+
+def read_timeline(path, module, config_opts):
+    """The timeline compiled by an animap module to path, see Timeline.save.
+
+    Its frames are dated from the start_date and frames_per_day it was compiled with, which must
+    be those of the config; a different title format only titles the frames again."""
+    try:
+        timeline = Timeline.load(path)
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+        print("\t[!] {} is NOT a compiled timeline! Please compile one with --compile".format(path))
+        sys.exit()
+    if str(timeline.arrays.get("module")) != module:
+        print("\t[!] {} was compiled by animap {}, not {}".format(path, timeline.arrays.get("module"), module))
+        sys.exit()
+    for key in ("title_format", "start_date", "frames_per_day"):
+        if key not in timeline.params:
+            print("\t[!] {} was compiled without its {}, please compile it again with --compile".format(path, key))
+            sys.exit()
+    for key in ("start_date", "frames_per_day"):
+        if timeline.params[key] != (config_opts[key].isoformat() if key == "start_date" else config_opts[key]):
+            print("\t[!] {} was compiled with {} {}, not {} as in the config".format(path, key, timeline.params[key], config_opts[key]))
+            sys.exit()
+    return timeline
+
+def load_npz(path):
+    """The arrays of an uncompressed .npz file, mapped in place where possible."""
+    arrays = {}
+    with zipfile.ZipFile(path) as archive, open(path, "rb") as f:
+        for info in archive.infolist():
+            name = info.filename[:-len(".npy")]
+            # the npy data starts after the local header of the member and the npy header
+            f.seek(info.header_offset)
+            local = f.read(30)
+            f.seek(info.header_offset + 30 + int.from_bytes(local[26:28], "little") + int.from_bytes(local[28:30], "little"))
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+            if info.compress_type != zipfile.ZIP_STORED or dtype.hasobject or len(shape) == 0 or 0 in shape:
+                with archive.open(info) as member:
+                    arrays[name] = np.lib.format.read_array(member)
+            else:
+                arrays[name] = np.memmap(path, dtype=dtype, mode="r", offset=f.tell(), shape=shape, order="F" if fortran else "C")
+    return arrays
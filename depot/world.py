@@ -1,38 +1,98 @@
 #!/usr/bin/env python
 """
     Usage:
-      animap world -c <FILE> -o <DIR>
+      animap world -c <FILE> -o <DIR> [-s <SHARD>] [-t <TIMELINE>] [-m <FILE>] [-p <DIR>]
+      animap world -c <FILE> -o <DIR> --compile [-t <TIMELINE>] [-m <FILE>] [-p <DIR>]
+      animap world -c <FILE> --plan [-t <TIMELINE>]
+      animap world -c <FILE> -o <DIR> --preview [--every <DAYS>] [--window <DATES>] [--dpi <DPI>] [--sheet] [-t <TIMELINE>]
+      animap world -c <FILE> -o <DIR> --watch [--interval <SECONDS>] [-m <FILE>]
 
     Options:
       -h, --help                    show this
       -c, --config_file <FILE>      config_file
       -o, --output <DIR>            creates a directory for all output files
+      -s, --shard <SHARD>           renders only shard i/N or output frames first:last, see animap merge
+      -t, --timeline <TIMELINE>     renders a timeline compiled before instead of parsing the csv files
+      --compile                     only compiles the timeline, to <TIMELINE> or timeline.npz in the output directory
+      -m, --metrics <FILE>          writes the time spent in every stage as JSON, or CSV for a .csv file
+      -p, --profile <DIR>           writes a cProfile of the main process and of every worker to <DIR>
+      --plan                        reports the frames, events and estimated render time without rendering
+      --preview                     renders the first frame of every few days at a low dpi with coarse outlines
+      --every <DAYS>                days between preview frames [default: 7]
+      --window <DATES>              previews only the days from:to, as Year-Month-Day:Year-Month-Day, either side optional
+      --dpi <DPI>                   dpi of the preview, half the dpi of the config file by default
+      --sheet                       also tiles the preview frames into contact_sheet.png
+      --watch                       renders again on every change of the config or csv files, only the frames that changed
+      --interval <SECONDS>          seconds between checks of the files watched [default: 2]
 """
 
-import matplotlib.pyplot as plt
-import geopandas as gpd
-import csv
+import os
 import sys
-import time
-import math
 import yaml
-import shutil
+import numpy as np
 
 from docopt import docopt
-from datetime import date, timedelta
-from unidecode import unidecode
-from multiprocessing import Pool
+from functools import partial
+
+from depot.timeline import Timeline, read_timeline
+from depot.ingest import CHUNK_ROWS, read_chunks, to_numbers, day_offsets, key_index, lookup
+from depot.raster import attach, composite_frame
+from depot.geocache import read_map, lod_tolerance
+from depot.AniMapLib import render_outputs, watch, unchanged_keys, name_index, match_names, report_unmatched, arc_ids, curved_lines, split, arc_range, title, dedup_frames, timer, start_profile, start_worker_metrics, finish_run, check_config, plan, job_index, get_outdir, cache_background, draw_frame, frame_pixels, axes_pixels, fill_layer, patch_index, fill_colors, recolor
+
+# Static base map and geodata of this worker, set once by init_worker
+_base = None
+
+def init_worker(maps, dpi, figure_size, sink, timeline, patches=None, profile_dir=None):
+    global _base
+    start_worker_metrics(profile_dir)
+    with timer("worker setup"):
+        _base = base_map(maps, dpi, figure_size)
+        if isinstance(timeline, str):
+            timeline = Timeline.load(timeline)
+    _base.update({"sink": sink, "timeline": timeline, "patches": None})
+    if patches is not None:
+        _base["shm"], _base["patches"] = attach(patches)
+
+# Events visible on frame t, resolved from the timeline intervals
+def frame_events(timeline, t):
+    L = []
+
+    c = timeline.layers.get("c")
+    names = timeline.arrays.get("c_names")
+    for e in timeline.active("c", t):
+        if t - c["origin"][e] < c["red"][e]:
+            L.append(["c", names[c["country"][e]], names[c["region"][e]], "red"])
+        else:
+            L.append(["c", names[c["country"][e]], names[c["region"][e]], "blue"])
 
-from depot.AniMapLib import get_values_curved_line, split, progress, title, get_outdir
+    l = timeline.layers.get("l")
+    for e in timeline.active("l", t):
+        L.append(["l", int(l["arc"][e]), *arc_range(t - l["center"][e], timeline.params["nums_end"])])
 
-def fplot(j_list):
+    return L
 
+# Estimated render time of frames in ms: the fixed cost of a frame plus that of its shaded countries and arcs
+def frame_costs(timeline, frames):
+    return 30 + 0.3 * timeline.counts("c", frames) + 1.7 * timeline.counts("l", frames)
 
-    fig = plt.figure(figsize=(12,6))
+def layout(dpi, figure_size=None):
+    import matplotlib.pyplot as plt
+    fig = plt.figure(figsize=figure_size or (12,6), dpi=dpi)
     ax1 = fig.add_subplot()
+    return fig, ax1
+
+# The whole map with the default margins of matplotlib
+def map_view(data):
+    xmin, ymin, xmax, ymax = data.total_bounds
+    dx, dy = (xmax - xmin) * 0.05, (ymax - ymin) * 0.05
+    return (xmin - dx, ymin - dy, xmax + dx, ymax + dy)
+
+def base_map(maps, dpi, figure_size=None):
+    data, view = maps
+
+    fig, ax1 = layout(dpi, figure_size)
 
-    #j_list contents
-    L, Title, i, k, out_dir, data, dpi = j_list
     #Ax1 --points
     data.plot(ax=ax1,edgecolor='darkgrey',facecolor='white',linewidth=.4)
 
@@ -44,76 +104,76 @@ def fplot(j_list):
     data.loc[data['name'] == "Australia"].plot(ax=ax1,facecolor='none',edgecolor='black',linewidth=0.4)
 
     # Title
-    fig.suptitle(Title)
-
-    for frame in L:
-        if frame[0] == "c":
-            if frame[2] != "":
-                data[data.r_name==frame[2]].plot(ax=ax1,color=frame[3],alpha=0.5)
-            else:
-                data[data.name==frame[1]].plot(ax=ax1,color=frame[3],alpha=0.5)
-        elif frame[0] == "l":
-            ax1.plot(frame[1], frame[2], color="black",linewidth=0.8)
+    suptitle = fig.suptitle("")
 
+    # Fix the view so the dynamic layers cannot rescale it
+    ax1.set_xlim([view[0],view[2]])
+    ax1.set_ylim([view[1],view[3]])
     ax1.set_aspect("auto")
 
-    frame_name = out_dir + "/frame_%05d.png"%(i)
-    plt.savefig(frame_name,format="png", dpi=dpi)
-    plt.close()
+    # Artists drawn above the dynamic layers are redrawn after them
+    overlays = list(ax1.spines.values())
+    background = cache_background(fig, overlays)
 
-    #Copy same frames
-    f=1
-    while f < k:
-        same_frame_name = out_dir + "/frame_%05d.png"%(i+f)
-        shutil.copyfile(frame_name,same_frame_name)
-        f += 1
+    # Countries and regions are shaded by recoloring one collection of the whole map
+    fills, rows = fill_layer(ax1, data.geometry)
 
+    return {"fig": fig, "ax1": ax1, "suptitle": suptitle, "fills": fills,
+            "fills_index": patch_index(data.name, rows), "r_fills_index": patch_index(data.r_name, rows), "overlays": overlays, "background": background}
 
-def main():
-    args = docopt(__doc__)
-    config_yaml = args['--config_file']
-    out_dir = get_outdir(args['--output'])
+def fplot(j_list):
 
-    # Load config_file
-    stream = open(config_yaml, 'r')
-    config_opts = yaml.safe_load(stream)
-    stream.close()
+    #j_list contents
+    t, Title, i, dups = j_list
+    with timer("frame events"):
+        L = frame_events(_base["timeline"], t)
+    ax1 = _base["ax1"]
+    fills_index, r_fills_index = _base["fills_index"], _base["r_fills_index"]
 
-    threads = config_opts["threads"]
-    dpi = config_opts["dpi"]
+    # Title
+    _base["suptitle"].set_text(Title)
+
+    artists = []
+    fills = []
+    with timer("frame artists"):
+        for frame in L:
+            if frame[0] == "c":
+                if frame[2] != "":
+                    if frame[2] in r_fills_index:
+                        fills.append((r_fills_index[frame[2]], frame[3], 0.5))
+                elif frame[1] in fills_index:
+                    fills.append((fills_index[frame[1]], frame[3], 0.5))
+            elif frame[0] == "l":
+                x_values, y_values = _base["timeline"].arrays["arcs"][frame[1], :, frame[2]:frame[3]]
+                artists += ax1.plot(x_values, y_values, color="black",linewidth=0.8)
+
+    if _base["patches"] is not None:
+        rgba = fill_colors(len(_base["patches"]["bounds"]) - 1, fills)
+        composite_frame(_base["fig"], _base["background"], _base["patches"], rgba, ax1, [], artists + _base["overlays"] + [_base["suptitle"]])
+    else:
+        recolor(_base["fills"], fills)
+        draw_frame(_base["fig"], _base["background"], [_base["fills"]] + artists + _base["overlays"] + [_base["suptitle"]])
+
+    with timer("frame save"):
+        frame = _base["sink"].render(frame_pixels(_base["fig"]), i, dups)
+    with timer("frame artists"):
+        for artist in artists:
+            artist.remove()
+    return frame
+
+
+def compile_timeline(config_opts, countries, countries_index, regions, regions_index, previous=None):
+    """Built timeline of the cases and transfers, holding the frames, titles and dedup groups of the animation.
+
+    Frames before the first change from a previous timeline keep its keys instead of being resolved again."""
     title_format = config_opts["title_format_world"]
     frames_per_day = config_opts["frames_per_day"]
     frames_for_line = config_opts["frames_for_line"]
     start_date = config_opts["start_date"]
     end_date = config_opts["end_date"]
-    world_json = config_opts["world_json"]
     world_cases = config_opts["world_cases"]
     centroids_file = config_opts["centroids_file"]
     transfers_file = config_opts["world_transfers_file"]
-    ##
-
-    st = time.time() #tm
-    # Parse world json
-    data = gpd.read_file(world_json)
-
-    countries = []
-    for name in data.name:
-        if isinstance(name, str):
-            countries.append(name)
-    countries = [f for f in countries if f is not None]
-
-    regions = []
-    for name in data.r_name:
-        if isinstance(name, str):
-            regions.append(name)
-    regions = [f for f in regions if f is not None]
-
-    et = time.time() - st #tm
-    print("Loaded map in " + str(int(et)) + " seconds.") #tm
-
-    # multiprocessing
-    p = Pool(threads)
-
 
     delta = end_date - start_date
     delta_days = delta.days
@@ -122,152 +182,148 @@ def main():
     # graph title
     Title=title(title_format,start_date,delta_days,frames_per_day)
 
-    L=[[] for x in range(limit)]
-
-    st = time.time() #tm
+    # the title settings are kept so a compiled timeline is titled as it was compiled, see read_timeline
+    timeline = Timeline(limit, title_format=title_format, start_date=start_date.isoformat(), frames_per_day=frames_per_day,
+                        nums_end=split(30,frames_for_line))
 
     #Cases
-    with open(world_cases) as csvfile:
-        reader = csv.reader(csvfile,delimiter=",")
-        for row in reader:
-            i_id = row.index('ID')
-            i_day = row.index('Day')
-            i_month = row.index('Month')
-            i_year = row.index('Year')
-            i_country = row.index('Country')
-            i_region = row.index('Region')
-            i_end = row.index('End')
-            break
-
-        for row in reader:
-            id_name = row[i_id]
-            country = row[i_country]
-            region = row[i_region]
-            end = row[i_end]
-            c_found = 0
-            r_found = 0
-            for name in countries:
-                if unidecode(name.lower()) == unidecode(country.lower()):
-                    country = name
-                    c_found = 1
-
-            for name in regions:
-                if region == "":
-                    r_found = 1
-                if unidecode(name.lower()) == unidecode(region.lower()):
-                    region = name
-                    r_found = 1
-
-            country_date = date(int(row[i_year]),int(row[i_month]),int(row[i_day]))
-            delta = country_date - start_date
-            start = delta.days * frames_per_day
-            if end == "":
-                end = limit
-            else:
-                end = int(end)
-            e = 0
-            for f in range(limit - start):
-                if e < end:
-                    loc = ["c",country,region,"red"]
-                    L[start+f].append(loc)
-                else:
-                    loc = ["c",country,region,"blue"]
-                    L[start+f].append(loc)
-                e += 1
-
-            if not c_found:
-                print(country)
-                sys.exit()
-            if not r_found:
-                print(region)
+    unmatched_countries = {}
+    unmatched_regions = {}
+    # country and region names of the cases as codes into one table, "" for no region
+    names = {"": 0}
+    chunk_rows = config_opts.get("chunk_rows", CHUNK_ROWS)
+    with timer("parse cases", "Parsed cases file in {:.2f} seconds."):
+        columns = {"Day": np.int32, "Month": np.int32, "Year": np.int32, "Country": str, "Region": str, "End": str}
+        for chunk in read_chunks(world_cases, columns, chunk_rows):
+            # names as in the map where found
+            distinct, found, inverse = match_names(countries_index, chunk["Country"], unmatched_countries)
+            country = np.array([names.setdefault(countries[f[-1]] if f else str(name), len(names)) for name, f in zip(distinct, found)], dtype=np.uint32)[inverse]
+            distinct, found, inverse = match_names(regions_index, chunk["Region"], unmatched_regions)
+            region = np.array([names.setdefault(regions[f[-1]] if f and name != "" else str(name), len(names)) for name, f in zip(distinct, found)], dtype=np.uint32)[inverse]
+
+            start = day_offsets(chunk, world_cases, start_date) * frames_per_day
+            ended = chunk["End"] != ""
+            # cases without an end stay red however long the animation runs
+            end = np.full(len(start), np.iinfo(np.int64).max, dtype=np.int64)
+            end[ended] = to_numbers(chunk["End"][ended], np.int64, world_cases, "End", chunk["row"][ended])
+            # red for the first end frames of the case, blue afterwards
+            timeline.extend("c", start, np.full(len(start), limit), country=country, region=region, origin=start, red=end)
+    timeline.arrays["c_names"] = np.array(list(names), dtype=str)
+    # cases without a region are not matched
+    unmatched_regions.pop("", None)
+
+    #check_errors, cases of unknown countries cannot be drawn
+    report_unmatched(unmatched_regions, "region")
+    report_unmatched(unmatched_countries, "country")
+    if unmatched_countries:
+        sys.exit()
 
     #Centroids
-    centroids={}
-    with open(centroids_file) as csvfile:
-        reader = csv.reader(csvfile,delimiter=",")
-        for row in reader:
-            i_id = row.index('Region')
-            i_latitude = row.index('Latitude')
-            i_longtitude = row.index('Longitude')
-            break
-
-        for row in reader:
-            id = row[i_id]
-            latitude = float(row[i_latitude])
-            longtitude = float(row[i_longtitude])
-            centroids[id] = {}
-            centroids[id]["loc"] = [longtitude,latitude]
-
-    et = time.time() - st #tm
-    print("Parsed centroids file in " + str(int(et)) + " seconds.") #tm
-
-    st = time.time() #tm
-    #Transfer file
+    names, locs = [], []
+    with timer("parse centroids", "Parsed centroids file in {:.2f} seconds."):
+        for chunk in read_chunks(centroids_file, {"Region": str, "Latitude": np.float32, "Longitude": np.float32}, chunk_rows):
+            names.append(chunk["Region"])
+            locs.append(np.stack([chunk["Longitude"], chunk["Latitude"]], axis=1))
+    names = np.concatenate(names) if names else np.array([], dtype=str)
+    locs = np.concatenate(locs) if locs else np.zeros((0, 2), dtype=np.float32)
+    index = key_index(names)
 
-    with open(transfers_file) as csvfile:
-        reader = csv.reader(csvfile,delimiter=",")
-        for row in reader:
-            i_from = row.index('from')
-            i_to = row.index('to')
-            i_day = row.index('Day')
-            i_month = row.index('Month')
-            i_year = row.index('Year')
-            break
-
-        for row in reader:
-            point_date = date(int(row[i_year]),int(row[i_month]),int(row[i_day]))
-            delta = point_date - start_date
-            start = delta.days * frames_per_day
-            if start < limit: #GK still if too early or too late
-                x_values, y_values = get_values_curved_line(centroids[row[i_from]]["loc"],centroids[row[i_to]]["loc"])
-                nums_end = split(len(x_values),frames_for_line)
-                values = [x_values,y_values]
-                L[start].append(["l",x_values,y_values])
-                for i in range(frames_for_line-1):
-                    diff = i + 1
-                    sdiff = frames_for_line - diff
-                    loc = ["l", x_values[:nums_end[i]], y_values[:nums_end[i]]]
-                    L[start-sdiff].append(loc)
-                    loc = ["l", x_values[nums_end[i]:nums_end[-1]],y_values[nums_end[i]:nums_end[-1]]]
-                    L[start+diff].append(loc)
-
-    et = time.time() - st #tm
-    print("Parsed transfers file in " + str(int(et)) + " seconds.") #tm
-
-    #Plotting the frames
-    st = time.time() #tm
-    j_list=[]
-
-    for i in range(len(Title)):
-        k = 1
-        j = [L[i] ,Title[i] ,i , k, out_dir, data, dpi]
-        j_list.append(j)
-
-    # Copy same frames
-    sj_list = []
-    k = 1
-    i = 0
-    while ((i + k) < len(Title)):
-        if j_list[i][0][-1][0] != "l" and j_list[i+k][0][-1][0] != "l" and j_list[i][0] == j_list[i+k][0] and j_list[i][1] == j_list[i+k][1]:
-            k += 1
-        else:
-            j_list[i][3] += k - 1
-            sj_list.append(j_list[i])
-            i += k
-            k = 1
-
-        # For the last frame
-        if (i + k) == len(Title):
-            j_list[i][3] += k - 1
-            sj_list.append(j_list[i])
+    #Transfer file
+    arcs = {}
+    with timer("parse transfers", "Parsed transfers file in {:.2f} seconds."):
+        columns = {"from": str, "to": str, "Day": np.int32, "Month": np.int32, "Year": np.int32}
+        for chunk in read_chunks(transfers_file, columns, chunk_rows):
+            start = day_offsets(chunk, transfers_file, start_date) * frames_per_day
+            drawn = start < limit #GK still if too early or too late
+            start, rows = start[drawn], chunk["row"][drawn]
+            frm = lookup(chunk["from"][drawn], index, transfers_file, "from", rows)
+            to = lookup(chunk["to"][drawn], index, transfers_file, "to", rows)
+            # the arc is drawn in over the frames before the transfer and out over the frames after
+            kept = (np.maximum(start - frames_for_line + 1, 0) < np.minimum(start + frames_for_line, limit))
+            frm, to, start = frm[kept], to[kept], start[kept]
+            arc = arc_ids(arcs, np.concatenate([locs[frm], locs[to]], axis=1))
+            timeline.extend("l", start - frames_for_line + 1, start + frames_for_line, arc=arc, center=start)
+    # one arc per pair of endpoints, computed all at once
+    timeline.arrays["arcs"] = curved_lines(np.array(list(arcs), dtype=float).reshape(len(arcs), 2, 2))
+    with timer("timeline build"):
+        timeline.build()
+
+    # Frames with the same content are rendered once
+    with timer("dedup"):
+        known = unchanged_keys(previous, timeline, range(limit), Title, tables=("arcs", "c_names"))
+        j_list, keys = dedup_frames(range(limit), Title, partial(frame_events, timeline), known, config_opts["threads"])
+    if previous is not None:
+        print("Kept {} of {} frames from the last pass".format(len(known), limit))
+    timeline.arrays["module"] = np.array("world")
+    timeline.arrays["frames"] = np.arange(limit, dtype=np.int64)
+    timeline.arrays["titles"] = np.array(Title, dtype=str)
+    timeline.arrays["job_of"] = job_index(j_list, limit)
+    timeline.arrays["keys"] = np.array(keys, dtype=str)
+    return timeline
+
+# The map simplified to lod_pixels of a pixel, as full map for 0, and its view
+def draw_maps(config_opts, data, dpi, figure_size, lod_pixels):
+    view = map_view(data)
+    if not lod_pixels:
+        return data, view
+    import matplotlib.pyplot as plt
+    fig, ax1 = layout(dpi, figure_size)
+    draw_data = read_map(config_opts["world_json"], config_opts.get("cache_dir"), lod_tolerance(view, axes_pixels(ax1), lod_pixels))
+    plt.close(fig)
+    return draw_data, view
+
+def run(args, previous=None):
+    """One run of the command line, returns the timeline; previous is the timeline of the last run of --watch."""
+    config_yaml = args['--config_file']
+    out_dir = None if args['--plan'] else get_outdir(args['--output'])
 
-    i=0
-    for i, _ in enumerate(p.imap_unordered(fplot,sj_list),1):
-        progress(i,1,len(sj_list))
+    # Load config_file
+    stream = open(config_yaml, 'r')
+    config_opts = yaml.safe_load(stream)
+    stream.close()
+    parse = args['--compile'] or not args['--timeline']
+    check_config(config_opts, "world", parse)
 
+    threads = config_opts["threads"]
+    world_json = config_opts["world_json"]
+    name_aliases = config_opts.get("name_aliases")
+    cache_dir = config_opts.get("cache_dir")
+    ##
 
+    if args['--profile']:
+        start_profile(args['--profile'], "main")
+
+    # a plan of a compiled timeline needs no map
+    if parse or not args['--plan']:
+        with timer("map load", "Loaded map in {:.2f} seconds."):
+            data = read_map(world_json, cache_dir)
+
+    if parse:
+        countries = list(data.name)
+        regions = list(data.r_name)
+        timeline = compile_timeline(config_opts, countries, name_index(countries, name_aliases), regions, name_index(regions, name_aliases), previous)
+        if args['--compile']:
+            timeline_file = args['--timeline'] or os.path.join(out_dir, "timeline.npz")
+            with timer("timeline save"):
+                timeline.save(timeline_file)
+            print("Compiled timeline to " + timeline_file)
+            finish_run(args['--metrics'], module="world", stage="compile", frames=len(timeline.arrays["frames"]))
+            return timeline
+        worker_timeline = timeline
+    else:
+        # every worker maps the compiled timeline from the file instead of receiving a copy
+        timeline = read_timeline(args['--timeline'], "world", config_opts)
+        worker_timeline = args['--timeline']
+    if args['--plan']:
+        plan(timeline, threads, frame_costs)
+        return timeline
+    # Every variant of the output renders the same map and timeline, see render_outputs
+    render_outputs(args, config_opts, out_dir, "world", timeline, worker_timeline, partial(draw_maps, config_opts, data), base_map, init_worker, fplot, frame_costs, (world_json,))
+    return timeline
 
-    et = time.time() - st #tm
-    num_frames = len(Title)
-    pfps = round(num_frames/et,1)
-    print("Plotted " + str(num_frames) + " frames in " + str(int(et)) + " seconds (" + str(pfps) + "/s)") #tm
+def main():
+    args = docopt(__doc__)
+    if args['--watch']:
+        watch(args['--config_file'], "world", partial(run, args), float(args['--interval']))
+    else:
+        run(args)